@@ -88,9 +88,14 @@ def main():
                         choices=[
                             "backup",
                             "check",
+                            "find",
+                            "history",
+                            "index",
                             "init",
                             "ls",
+                            "metrics",
                             "prune",
+                            "restore",
                             "setup",
                             "snapshots",
                             "stats",
@@ -100,7 +105,20 @@ def main():
     parser.add_argument("--etcdir", default=ETCDIR, help="Directory with backup configurations")
     parser.add_argument("-H", "--hostname", help="SSH hostname")
     parser.add_argument("-p", "--port", default=22, help="SSH port")
-    parser.add_argument("--id", help="Restic snapshot id")
+    parser.add_argument("--id", help="Restic snapshot id, restore: comma separated list")
+    parser.add_argument("--days", type=int, default=30, help="Number of days of history")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of hosts to backup in parallel")
+    parser.add_argument("--path", help="ls, only files under this path, or matching a glob pattern. find, pattern")
+    parser.add_argument("--limit", type=int, help="ls and find, max number of files to show")
+    parser.add_argument("--min-size", help="ls, only files of at least this size, e.g. 10M")
+    parser.add_argument("--max-size", help="ls, only files of at most this size")
+    parser.add_argument("--newer", help="ls, only files modified after, e.g. 7d or 2024-01-31")
+    parser.add_argument("--older", help="ls, only files modified before")
+    parser.add_argument("--target", help="restore, directory on target host")
+    parser.add_argument("--target-host", help="restore, host to restore to, default --hostname")
+    parser.add_argument("--include", action="append", help="restore, only restore files matching pattern")
+    parser.add_argument("--exclude", action="append", help="restore, do not restore files matching pattern")
+    parser.add_argument("--refresh", action="store_true", help="Run restic, do not use cached snapshots and stats")
     parser.add_argument("-d", "--debug", help="Show debug info")
     parser.add_argument("--email",
                         help="Email addresses, backup summary is sent here",
@@ -110,16 +128,21 @@ def main():
     args = parser.parse_args()
     
     backups = Backups()
-    restic = Restic(config=config, backups=backups)
+    try:
+        restic = Restic(config=config, backups=backups)
+    except ValueError as err:
+        print("Error: %s" % err)
+        sys.exit(1)
     headers = [
         "hostname", "name", "type", "subname",
         "files<br>new", "files<br>changed", "files<br>unmodified",
         "dirs<br>new", "dirs<br>changed", "dirs<br>unmodified",
-        "total<br>files", "total<br>bytes", "duration", "snapshot ID",
+        "total<br>files", "total<br>bytes", "duration",
+        "MB/s<br>avg", "MB/s<br>peak", "snapshot ID", "downtime",
     ]
 
     if args.cmd == "backup":
-        backups = restic.backup(hostname_filter=args.hostname, port=args.port)
+        backups = restic.backup(hostname_filter=args.hostname, port=args.port, jobs=args.jobs or 1)
 
         t = citobackup_util.Table(headers=headers)
 
@@ -143,10 +166,19 @@ def main():
                     tmp = citobackup_util.human_readable_size(result.total_bytes_processed)
                     t.add_cell(tmp)
                     t.add_cell(round(result.total_duration, 1))
-                    t.add_cell(result.snapshot_id)
+                    t.add_cell(round(result.mbps_avg, 1))
+                    t.add_cell(round(result.mbps_peak, 1))
+                    if result.unchanged:
+                        t.add_cell("unchanged, %s" % result.snapshot_id)
+                    else:
+                        t.add_cell(result.snapshot_id)
                 else:
-                    for i in range(len(headers) - 4):
+                    for i in range(len(headers) - 5):
                         t.add_cell("")
+                if result.downtime is not None:
+                    t.add_cell(round(result.downtime, 1))
+                else:
+                    t.add_cell("")
  
                 t.add_row()
 
@@ -168,7 +200,19 @@ def main():
             print(t)
 
     elif args.cmd == "check":
-        restic.check(hostname_filter=args.hostname)
+        restic.check(hostname_filter=args.hostname, jobs=args.jobs)     # None, default from configuration
+
+    elif args.cmd == "find":
+        if args.path is None:
+            print("Error: must specify path")
+            sys.exit(1)
+        print(restic.find(args.path, hostname_filter=args.hostname, limit=args.limit))
+
+    elif args.cmd == "history":
+        print(restic.history(hostname_filter=args.hostname, days=args.days))
+
+    elif args.cmd == "index":
+        restic.index(hostname_filter=args.hostname, refresh=args.refresh, jobs=args.jobs)     # None, default from configuration
 
     elif args.cmd == "init":
         if args.hostname is None:
@@ -180,16 +224,43 @@ def main():
         if args.hostname is None or args.id is None:
             print("Error: must specify hostname and id")
             sys.exit(1)
-        restic.ls(hostname=args.hostname, id=args.id)
+        size_time = {}
+        for arg, parse in [["min_size", citobackup_util.parse_size], ["max_size", citobackup_util.parse_size],
+                           ["newer", citobackup_util.parse_age], ["older", citobackup_util.parse_age]]:
+            value = getattr(args, arg)
+            if value is not None:
+                size_time[arg] = parse(value)
+                if size_time[arg] is None:
+                    print("Error: invalid --%s %s" % (arg.replace("_", "-"), value))
+                    sys.exit(1)
+        restic.ls(hostname=args.hostname, id=args.id, refresh=args.refresh,
+                  path=args.path, limit=args.limit, **size_time)
+
+    elif args.cmd == "metrics":
+        print(restic.metrics(), end="")
 
     elif args.cmd == "prune":
-        restic.prune(hostname_filter=args.hostname)
+        restic.prune(hostname_filter=args.hostname, jobs=args.jobs)     # None, default from configuration
+
+    elif args.cmd == "restore":
+        if args.hostname is None or args.id is None or args.target is None:
+            print("Error: must specify hostname, id and target")
+            sys.exit(1)
+        res = restic.restore(hostname=args.hostname, ids=args.id.split(","), target=args.target,
+                             target_host=args.target_host, include=args.include, exclude=args.exclude,
+                             jobs=args.jobs or 1)
+        if res is None:
+            sys.exit(1)
+        t, errors = res
+        print(t)
+        if errors:
+            sys.exit(1)
 
     elif args.cmd == "snapshots":
-        restic.snapshots(hostname_filter=args.hostname)
+        restic.snapshots(hostname_filter=args.hostname, refresh=args.refresh, jobs=args.jobs)     # None, default from configuration
 
     elif args.cmd == "stats":
-        restic.stats(hostname_filter=args.hostname)
+        restic.stats(hostname_filter=args.hostname, refresh=args.refresh, jobs=args.jobs)     # None, default from configuration
 
     elif args.cmd == "unlock":
         restic.unlock(hostname_filter=args.hostname)
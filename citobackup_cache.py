@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Local cache of restic repository metadata
+
+restic loads the repository index for each command. The snapshot list and
+stats of a repository only change when files in its index/ or snapshots/
+directories change. The names of these files are content addressed, so
+the list of names is a cheap key for the repository state.
+"""
+
+import gzip
+import hashlib
+import os
+
+import citobackup_util
+
+
+class Repo_Cache:
+    """
+    Cached data for one repository, in ~/.cache/citobackup/repo/<hostname>
+
+    Data saved with save() is valid as long as the repository state is the
+    same. Listings of a snapshot never change, they are kept until the
+    snapshot is removed from the repository.
+    """
+    def __init__(self, repo, hostname):
+        self.repo = repo            # Path to repository on backup server
+        self.hostname = hostname
+        self.directory = os.path.dirname(citobackup_util.cache_file("repo", hostname, "x"))
+        self._key = None
+
+    def key(self):
+        """
+        Return key for the current state of the repository
+        None if the repository does not exist
+        """
+        if self._key is None:
+            h = hashlib.sha256()
+            for directory in ["index", "snapshots"]:
+                try:
+                    names = sorted(os.listdir(os.path.join(self.repo, directory)))
+                except OSError:
+                    return None
+                h.update(("%s:%s\n" % (directory, ",".join(names))).encode())
+            self._key = h.hexdigest()
+        return self._key
+
+    def load(self, name):
+        """
+        Return cached data, None if there is none or the repository has changed
+        """
+        data = citobackup_util.load_json(os.path.join(self.directory, name + ".json"))
+        if data is None or self.key() is None or data.get("key") != self.key():
+            return None
+        return data["data"]
+
+    def save(self, name, data):
+        """
+        Save data, valid for the current repository state
+        """
+        if self.key() is None:
+            return
+        citobackup_util.save_json(os.path.join(self.directory, name + ".json"), {"key": self.key(), "data": data})
+
+    def ls_file(self, snapshot_id):
+        return os.path.join(self.directory, "ls-%s.json.gz" % snapshot_id)
+
+    def load_ls(self, snapshot_id):
+        """
+        Return cached listing of a snapshot as an open file, restic ls --json
+        lines. None if not cached
+        """
+        try:
+            return gzip.open(self.ls_file(snapshot_id), "rt")
+        except OSError:
+            return None
+
+    def save_ls(self, snapshot_id, lines, complete=None):
+        """
+        Save listing of a snapshot while it is read, yields each line
+        The cache is only written if all lines are read, and complete()
+        returns true
+        """
+        filename = self.ls_file(snapshot_id)
+        tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+        it = iter(lines)
+        try:
+            with gzip.open(tmpfile, "wt") as f:
+                for line in it:
+                    f.write(line)
+                    yield line
+            if complete is None or complete():
+                os.replace(tmpfile, filename)
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    def expire_ls(self, snapshot_ids):
+        """
+        Remove cached listings of snapshots not in snapshot_ids
+        """
+        for filename in os.listdir(self.directory):
+            if filename.startswith("ls-"):
+                if filename[3:].split(".")[0] not in snapshot_ids or not filename.endswith(".json.gz"):
+                    os.unlink(os.path.join(self.directory, filename))
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+
+"""
+Local history of backup runs, in a SQLite database
+
+Each backup run, and the result of each item on each host, is saved. This
+gives trends over time without asking restic, and the time of the last
+successful backup of an item.
+
+Path index, paths of all files in all snapshots, to find which backups
+have a file.
+"""
+
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import threading
+import time
+
+import citobackup_util
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    cmd TEXT NOT NULL,
+    node TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+);
+
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    hostname TEXT NOT NULL,
+    name TEXT NOT NULL,
+    subname TEXT NOT NULL,
+    backup_type TEXT NOT NULL,
+    started REAL NOT NULL,
+    files_new INTEGER,
+    files_changed INTEGER,
+    files_unmodified INTEGER,
+    dirs_new INTEGER,
+    dirs_changed INTEGER,
+    dirs_unmodified INTEGER,
+    total_files_processed INTEGER,
+    total_bytes_processed INTEGER,
+    data_added INTEGER,
+    total_duration REAL,
+    mbps_avg REAL,
+    mbps_peak REAL,
+    downtime REAL,
+    snapshot_id TEXT NOT NULL,
+    unchanged INTEGER NOT NULL,
+    error_count INTEGER NOT NULL,
+    errors TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_item ON results(hostname, name, subname, started);
+CREATE INDEX IF NOT EXISTS results_started ON results(started);
+CREATE INDEX IF NOT EXISTS results_run ON results(run_id);
+
+CREATE TABLE IF NOT EXISTS phases (
+    result_id INTEGER NOT NULL REFERENCES results(id),
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (result_id, phase)
+);
+"""
+
+# A result is successful if it has a snapshot and no errors
+SUCCESS = "error_count = 0 AND snapshot_id != ''"
+
+# The hostname row of a backup, with phases of the host and errors outside items
+HOST_ROW = "name = '' AND backup_type = ''"
+
+
+class History:
+    """
+    Backup history database
+    Results are added from several threads, writes are serialized with a lock
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = citobackup_util.cache_file("history.sqlite")
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def start_run(self, cmd):
+        """
+        Record start of a citobackup run, returns the run id
+        """
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT INTO runs (cmd, node, started) VALUES (?, ?, ?)",
+                (cmd, platform.node(), time.time()))
+            self.conn.commit()
+            return cur.lastrowid
+
+    def finish_run(self, run_id):
+        with self.lock:
+            self.conn.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), run_id))
+            self.conn.commit()
+
+    def add_results(self, run_id, hostname, results):
+        """
+        Save all Backup_Result of one host, in one transaction
+        """
+        with self.lock:
+            for r in results:
+                cur = self.conn.execute(
+                    "INSERT INTO results (run_id, hostname, name, subname, backup_type, started,"
+                    " files_new, files_changed, files_unmodified, dirs_new, dirs_changed, dirs_unmodified,"
+                    " total_files_processed, total_bytes_processed, data_added, total_duration,"
+                    " mbps_avg, mbps_peak, downtime, snapshot_id, unchanged, error_count, errors)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, r.hostname or hostname, r.name or "", r.subname or "", r.backup_type or "", r.started,
+                     r.files_new, r.files_changed, r.files_unmodified, r.dirs_new, r.dirs_changed, r.dirs_unmodified,
+                     r.total_files_processed, r.total_bytes_processed, r.data_added, r.total_duration,
+                     r.mbps_avg, r.mbps_peak, r.downtime, str(r.snapshot_id or ""), int(r.unchanged),
+                     len(r.errors), "\n".join(r.errors)))
+                for phase, seconds in r.phases.items():
+                    self.conn.execute(
+                        "INSERT INTO phases (result_id, phase, seconds) VALUES (?, ?, ?)",
+                        (cur.lastrowid, phase, seconds))
+            self.conn.commit()
+
+    def last_success(self, hostname, name=None, subname=None):
+        """
+        Return time of last successful backup of a host, or of one item on the host
+        None if there is none
+        """
+        sql = "SELECT MAX(started) FROM results WHERE hostname = ? AND " + SUCCESS
+        args = [hostname]
+        if name is not None:
+            sql += " AND name = ?"
+            args.append(name)
+        if subname is not None:
+            sql += " AND subname = ?"
+            args.append(subname)
+        with self.lock:
+            return self.conn.execute(sql, args).fetchone()[0]
+
+    def latest_results(self, hostnames=None):
+        """
+        Return the results of the last backup of each host, with the time of
+        the last successful backup of each item in column last_success
+        The hostname row (no name and backup_type) is successful if no result
+        of the host in that run has errors
+        """
+        host_filter = ""
+        args = []
+        if hostnames is not None:
+            host_filter = " AND hostname IN (%s)" % ",".join("?" * len(hostnames))
+            args = list(hostnames) * 3     # One filter in each of the subqueries
+        sql = "WITH last_run AS ("
+        sql += "SELECT hostname, MAX(run_id) AS run_id FROM results WHERE 1" + host_filter
+        sql += " GROUP BY hostname),"
+        sql += " host_success AS ("
+        sql += "SELECT hostname, run_id, MAX(CASE WHEN %s THEN started END) AS started" % HOST_ROW
+        sql += " FROM results WHERE 1" + host_filter
+        sql += " GROUP BY hostname, run_id HAVING SUM(error_count) = 0),"
+        sql += " last_success AS ("
+        sql += "SELECT hostname, name, subname, backup_type, MAX(started) AS started"
+        sql += " FROM results WHERE NOT (%s) AND %s" % (HOST_ROW, SUCCESS) + host_filter
+        sql += " GROUP BY hostname, name, subname, backup_type"
+        sql += " UNION ALL SELECT hostname, '', '', '', MAX(started) FROM host_success GROUP BY hostname)"
+        sql += " SELECT r.*, s.started AS last_success FROM results r"
+        sql += " JOIN last_run l ON r.hostname = l.hostname AND r.run_id = l.run_id"
+        sql += " LEFT JOIN last_success s ON r.hostname = s.hostname AND r.name = s.name"
+        sql += " AND r.subname = s.subname AND r.backup_type = s.backup_type"
+        sql += " ORDER BY r.hostname, r.id"
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def phases(self, result_ids):
+        """
+        Return phase timings of results, as {result_id: {phase: seconds}}
+        """
+        phases = {}
+        result_ids = list(result_ids)
+        with self.lock:
+            for ix in range(0, len(result_ids), 500):
+                chunk = result_ids[ix:ix + 500]
+                sql = "SELECT result_id, phase, seconds FROM phases WHERE result_id IN (%s)" % ",".join("?" * len(chunk))
+                for row in self.conn.execute(sql, chunk):
+                    phases.setdefault(row["result_id"], {})[row["phase"]] = row["seconds"]
+        return phases
+
+    def report(self, days=30, hostname=None):
+        """
+        Return one row per item with results in the last days, slowest items first
+        """
+        sql = "SELECT hostname, name, subname, backup_type, COUNT(*) AS runs,"
+        sql += " AVG(total_duration) AS avg_duration, MAX(total_duration) AS max_duration,"
+        sql += " SUM(data_added) AS data_added, SUM(error_count) AS errors,"
+        sql += " MAX(CASE WHEN %s THEN started END) AS last_success" % SUCCESS
+        sql += " FROM results WHERE started >= ? AND NOT (%s)" % HOST_ROW
+        args = [time.time() - days * 86400]
+        if hostname:
+            hosts = hostname.split(",")
+            sql += " AND hostname IN (%s)" % ",".join("?" * len(hosts))
+            args += hosts
+        sql += " GROUP BY hostname, name, subname, backup_type"
+        sql += " ORDER BY avg_duration DESC"
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+
+PATH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hostname TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL UNIQUE,
+    grp TEXT NOT NULL,
+    time REAL NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS snapshots_grp ON snapshots(hostname, grp, time);
+
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    hostname TEXT NOT NULL,
+    path TEXT NOT NULL,
+    UNIQUE (hostname, path)
+);
+
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    path_id INTEGER NOT NULL REFERENCES paths(id),
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime TEXT NOT NULL,
+    first_snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+    last_snapshot INTEGER NOT NULL REFERENCES snapshots(id)
+);
+CREATE INDEX IF NOT EXISTS versions_last ON versions(last_snapshot, path_id);
+CREATE INDEX IF NOT EXISTS versions_path ON versions(path_id);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS paths_fts USING fts5(path, content='paths', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS paths_ai AFTER INSERT ON paths BEGIN
+    INSERT INTO paths_fts(rowid, path) VALUES (new.id, new.path);
+END;
+CREATE TRIGGER IF NOT EXISTS paths_ad AFTER DELETE ON paths BEGIN
+    INSERT INTO paths_fts(paths_fts, rowid, path) VALUES ('delete', old.id, old.path);
+END;
+"""
+
+
+class Path_Index:
+    """
+    Index of the paths in all snapshots
+
+    Each version of a file (path, size, mtime) is stored once, with the first
+    and last snapshot it is in. A file version in the previous snapshot of the
+    same host and backup paths gets its last snapshot moved forward. Snapshots
+    must be added in time order.
+
+    Paths are full text indexed with FTS5 if available, so a query only looks
+    at paths with the words in the pattern.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = citobackup_util.cache_file("paths.sqlite")
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, timeout=600)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(PATH_SCHEMA)
+            try:
+                self.conn.executescript(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False    # SQLite without FTS5
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def indexed(self, hostname):
+        """
+        Return set of snapshot ids indexed for hostname
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT snapshot_id FROM snapshots WHERE hostname = ? AND removed = 0", (hostname,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def add_snapshot(self, hostname, snapshot, nodes):
+        """
+        Add a snapshot, snapshot as from restic snapshots --json
+        nodes is an iterable of nodes from restic ls --json, it is read once
+
+        The nodes are first written to a staging database of their own, so
+        the index is only locked while they are merged, not while restic ls
+        is running. Hosts can then be indexed in parallel.
+        Returns number of files
+        """
+        grp = json.dumps(sorted(snapshot.get("paths", None) or []))
+        t = citobackup_util.parse_time(snapshot["time"]) or 0
+        fd, staging = tempfile.mkstemp(prefix="paths-", suffix=".sqlite",
+                                       dir=os.path.dirname(os.path.abspath(self.filename)))
+        os.close(fd)
+        try:
+            s = sqlite3.connect(staging)
+            try:
+                s.execute("PRAGMA journal_mode=OFF")
+                s.execute("PRAGMA synchronous=OFF")
+                s.execute("CREATE TABLE new_nodes (path TEXT PRIMARY KEY, type TEXT, size INTEGER, mtime TEXT)")
+                s.executemany("INSERT OR REPLACE INTO new_nodes VALUES (?, ?, ?, ?)",
+                              ((n.get("path", ""), n.get("type", ""), n.get("size", 0) or 0, n.get("mtime", ""))
+                               for n in nodes))
+                s.commit()
+            finally:
+                s.close()
+            with self.lock:
+                return self.merge_snapshot(hostname, snapshot["id"], grp, t, staging)
+        finally:
+            os.unlink(staging)
+
+    def merge_snapshot(self, hostname, snapshot_id, grp, t, staging):
+        """
+        Add a snapshot with the nodes in table new_nodes of database staging
+        Called with the lock held. Returns number of files
+        """
+        c = self.conn
+        c.execute("ATTACH DATABASE ? AS staging", (staging,))
+        try:
+            try:
+                cur = c.execute("INSERT INTO snapshots (hostname, snapshot_id, grp, time) VALUES (?, ?, ?, ?)",
+                                (hostname, snapshot_id, grp, t))
+                sid = cur.lastrowid
+                row = c.execute("SELECT MAX(id) FROM snapshots WHERE hostname = ? AND grp = ? AND time < ? AND id != ?",
+                                (hostname, grp, t, sid)).fetchone()
+                prev = row[0] if row[0] is not None else -1
+                count = c.execute("SELECT COUNT(*) FROM staging.new_nodes").fetchone()[0]
+
+                c.execute("INSERT OR IGNORE INTO paths (hostname, path) SELECT ?, path FROM staging.new_nodes", (hostname,))
+                # File versions unchanged since the previous snapshot
+                c.execute("UPDATE versions SET last_snapshot = ? WHERE last_snapshot = ? AND EXISTS"
+                          " (SELECT 1 FROM staging.new_nodes n JOIN paths p ON p.hostname = ? AND p.path = n.path"
+                          "  WHERE p.id = versions.path_id AND n.size = versions.size AND n.mtime = versions.mtime"
+                          "  AND n.type = versions.type)",
+                          (sid, prev, hostname))
+                c.execute("INSERT INTO versions (path_id, type, size, mtime, first_snapshot, last_snapshot)"
+                          " SELECT p.id, n.type, n.size, n.mtime, ?, ? FROM staging.new_nodes n"
+                          " JOIN paths p ON p.hostname = ? AND p.path = n.path"
+                          " WHERE NOT EXISTS (SELECT 1 FROM versions v WHERE v.last_snapshot = ? AND v.path_id = p.id)",
+                          (sid, sid, hostname, sid))
+                c.commit()
+            except:
+                c.rollback()
+                raise
+        finally:
+            c.execute("DETACH DATABASE staging")
+        return count
+
+    def remove_snapshots(self, hostname, snapshot_ids):
+        """
+        Mark snapshots as removed from the repository
+        File versions not in any remaining snapshot are deleted
+        """
+        c = self.conn
+        with self.lock:
+            for snapshot_id in snapshot_ids:
+                c.execute("UPDATE snapshots SET removed = 1 WHERE hostname = ? AND snapshot_id = ?",
+                          (hostname, snapshot_id))
+            c.execute("DELETE FROM versions WHERE path_id IN (SELECT id FROM paths WHERE hostname = ?) AND NOT EXISTS"
+                      " (SELECT 1 FROM snapshots s, snapshots f, snapshots l"
+                      "  WHERE f.id = versions.first_snapshot AND l.id = versions.last_snapshot"
+                      "  AND s.hostname = f.hostname AND s.grp = f.grp AND s.removed = 0"
+                      "  AND s.time BETWEEN f.time AND l.time)", (hostname,))
+            c.execute("DELETE FROM paths WHERE hostname = ? AND NOT EXISTS"
+                      " (SELECT 1 FROM versions v WHERE v.path_id = paths.id)", (hostname,))
+            c.commit()
+
+    def fts_query(self, pattern, glob):
+        """
+        Return FTS5 query for words that must be in paths matching pattern
+
+        A word is a run of letters and digits. It is only used if it starts
+        after an ASCII separator, or at the start of a glob. It is a whole
+        word if it ends at an ASCII separator, or at the end of a glob, and a
+        prefix if it ends at a wildcard or at anything else. Letters in [...]
+        are never used. Returns None if there are no such words
+        """
+        # Literal characters of the pattern, None for a wildcard
+        chars = []
+        ix = 0
+        while ix < len(pattern):
+            ch = pattern[ix]
+            if glob and ch in "*?":
+                chars.append(None)
+            elif glob and ch == "[":
+                end = ix + 1
+                if pattern[end:end + 1] in ("!", "^"):
+                    end += 1
+                if pattern[end:end + 1] == "]":
+                    end += 1
+                end = pattern.find("]", end)
+                if end < 0:
+                    end = len(pattern)
+                chars.append(None)
+                ix = end
+            else:
+                chars.append(ch)
+            ix += 1
+
+        def separator(ch):
+            # The tokenizer splits on all ASCII characters except letters and digits
+            return ch is not None and ch < "\x80" and not ch.isalnum()
+
+        words = []
+        ix = 0
+        while ix < len(chars):
+            if chars[ix] is None or not chars[ix].isalnum():
+                ix += 1
+                continue
+            start = ix
+            while ix < len(chars) and chars[ix] is not None and chars[ix].isalnum():
+                ix += 1
+            word = "".join(chars[start:ix])
+            if start == 0:
+                if not glob:
+                    continue    # Substring, can be the end of a longer word
+            elif not separator(chars[start - 1]):
+                continue
+            if (ix == len(chars) and glob) or (ix < len(chars) and separator(chars[ix])):
+                words.append('"%s"' % word)
+            else:
+                words.append('"%s"*' % word)   # Prefix
+        if not words:
+            return None
+        return " AND ".join(words)
+
+    def sqlite_glob(self, pattern):
+        """
+        Return glob pattern for SQLite GLOB, which negates a [...] class
+        with ^, not with ! as the shell
+        """
+        res = ""
+        ix = 0
+        while ix < len(pattern):
+            ch = pattern[ix]
+            ix += 1
+            if ch == "[" and pattern[ix:ix + 1] == "!":
+                ch = "[^"
+                ix += 1
+            elif ch == "[":
+                pass
+            else:
+                res += ch
+                continue
+            # Rest of the class, a ] first in the class is a literal
+            end = ix + 1 if pattern[ix:ix + 1] == "]" else ix
+            end = pattern.find("]", end)
+            if end < 0:
+                end = len(pattern) - 1
+            res += ch + pattern[ix:end + 1]
+            ix = end + 1
+        return res
+
+    def find(self, pattern, hostname=None, limit=1000):
+        """
+        Find file versions with path matching pattern, glob if pattern
+        contains *?[, otherwise a substring
+
+        Returns rows with hostname, path, type, size, mtime, first and last
+        time the version was seen, and the latest remaining snapshot with it
+        """
+        glob = any(ch in pattern for ch in "*?[")
+        sql = "SELECT p.hostname, p.path, v.type, v.size, v.mtime, f.time AS first_seen, l.time AS last_seen,"
+        sql += " (SELECT s.snapshot_id FROM snapshots s WHERE s.hostname = f.hostname AND s.grp = f.grp"
+        sql += "  AND s.removed = 0 AND s.time BETWEEN f.time AND l.time ORDER BY s.time DESC LIMIT 1) AS snapshot_id"
+        sql += " FROM paths p JOIN versions v ON v.path_id = p.id"
+        sql += " JOIN snapshots f ON f.id = v.first_snapshot JOIN snapshots l ON l.id = v.last_snapshot"
+        args = []
+        where = []
+        query = self.fts_query(pattern, glob) if self.fts else None
+        if query:
+            where.append("p.id IN (SELECT rowid FROM paths_fts WHERE paths_fts MATCH ?)")
+            args.append(query)
+        if glob:
+            where.append("p.path GLOB ?")
+            args.append(self.sqlite_glob(pattern))
+        else:
+            where.append("instr(p.path, ?) > 0")
+            args.append(pattern)
+        if hostname:
+            hosts = hostname.split(",")
+            where.append("p.hostname IN (%s)" % ",".join("?" * len(hosts)))
+            args += hosts
+        sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY p.hostname, p.path, l.time DESC LIMIT ?"
+        args.append(limit)
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+
+if __name__ == "__main__":
+    # function test
+    import fnmatch
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+        history = History(f.name)
+        run_id = history.start_run("backup")
+        results = citobackup_util.Backup_Results()
+        r = citobackup_util.Backup_Result()
+        r.name = "etc"
+        r.backup_type = "files"
+        r.snapshot_id = "abcd1234"
+        r.total_duration = 2.5
+        r.data_added = 1000
+        r.add_phase("restic", 2.5)
+        results.add(r)
+        history.add_results(run_id, "host1", results)
+        history.finish_run(run_id)
+        for row in history.report():
+            print(dict(row))
+        print("last success", history.last_success("host1"))
+
+    # Path index, find must give the same paths as a plain GLOB or substring match
+    with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+        path_index = Path_Index(f.name)
+        paths = [
+            "/srv/backup5.tar", "/srv/backup.tar", "/srv/backup55.tar.gz", "/srv/mybackup5.tar",
+            "/var/log/app_1.log", "/var/log/app_12.log", "/var/log/myapp_1.log",
+            "/home/björn/notes.txt", "/home/bjorn/notes.txt", "/home/anna/björn.txt",
+            "/etc/nginx/sites-enabled/default", "/etc/nginx.conf",
+        ]
+        nodes = [{"path": path, "type": "file", "size": 1, "mtime": "2024-01-01T00:00:00Z"} for path in paths]
+        path_index.add_snapshot("host1", {"id": "s1", "time": "2024-01-01T00:00:00Z", "paths": ["/"]}, nodes)
+        for pattern in ["*/backup[0-9].tar", "*/app_[0-9].log", "/home/björn/*", "*björn*", "*/backup*",
+                        "*/[a-z]pp_1.log", "*/app_?.log", "*nginx*", "nginx", "app_1", "ckup5.t", "rn/notes",
+                        "*/backup[!5].tar", "*/app_[!0-9].log", "*/app_[!2]*.log", "/home/bj[!o]rn/*"]:
+            found = sorted(row["path"] for row in path_index.find(pattern))
+            if any(ch in pattern for ch in "*?["):
+                expected = sorted(p for p in paths if fnmatch.fnmatchcase(p, pattern))
+            else:
+                expected = sorted(p for p in paths if pattern in p)
+            print("%-20s %-40s %s" % (pattern, path_index.fts_query(pattern, pattern != pattern.strip("*?[")), found))
+            assert found == expected, "%s: %s != %s" % (pattern, found, expected)
+        path_index.close()
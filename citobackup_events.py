@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Typed events from restic json output
+
+restic writes one json message per line. The lines are decoded into events,
+and delivered to subscribers as they arrive.
+"""
+
+import json
+import sys
+import time
+
+import citobackup_util
+
+
+class Event:
+    """
+    One decoded message from restic
+    The message is available as a dict in data, or with get() and []
+    """
+    message_type = ""
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.data)
+
+
+class Status_Event(Event):
+    """
+    Progress, sent regularly while restic is running
+    """
+    message_type = "status"
+
+
+class Error_Event(Event):
+    """
+    Error on a file or directory, restic continues
+    """
+    message_type = "error"
+
+    @property
+    def msg(self):
+        try:
+            error = self.data["error"]
+            if "message" in error:
+                # restic >= 0.15
+                return "Error %s: %s" % (error["message"], self.data["item"])
+            return "Error %s(%s): %s" % (error["Op"], error["Err"], self.data["item"])
+        except (KeyError, TypeError) as err:
+            return f"Unknown error: {err}"
+
+
+class Summary_Event(Event):
+    """
+    Last message, the result of the backup
+    """
+    message_type = "summary"
+
+
+class Verbose_Status_Event(Event):
+    """
+    Status for one file or directory, only sent with --verbose=2
+    """
+    message_type = "verbose_status"
+
+
+class Unknown_Event(Event):
+    """
+    Any other message
+    """
+    @property
+    def message_type(self):
+        return self.data.get("message_type", "")
+
+
+EVENT_TYPES = {cls.message_type: cls for cls in [Status_Event, Error_Event, Summary_Event, Verbose_Status_Event]}
+
+# restic writes message_type first, status lines are recognized without decoding
+STATUS_PREFIX = '{"message_type":"status"'
+
+STATUS_INTERVAL = 0.5   # Seconds, status lines decoded for progress during backups
+
+
+class Event_Stream:
+    """
+    Decode restic json lines into events, and call subscribers
+
+    Status lines are the vast majority of the output. If nobody subscribes to
+    status events they are dropped without json decoding, and with
+    status_interval only one status line per status_interval seconds is
+    decoded.
+    """
+    def __init__(self, status_interval=0):
+        self.subscribers = {}   # message_type -> list of callbacks
+        self.status_interval = status_interval
+        self.last_status = None
+
+    def subscribe(self, message_type, callback):
+        """
+        Call callback(event) for each event of message_type
+        """
+        self.subscribers.setdefault(message_type, []).append(callback)
+
+    def feed(self, line):
+        """
+        Decode one line of output
+        Returns the event, or None if the line is not an event or is dropped
+        """
+        if line.startswith(STATUS_PREFIX):
+            if "status" not in self.subscribers:
+                return None
+            if self.status_interval:
+                now = time.monotonic()
+                if self.last_status is not None and now - self.last_status < self.status_interval:
+                    return None
+                self.last_status = now
+        if not line.strip():
+            return None
+        if line[0] != "{":
+            # not json
+            print("Unknown", line)
+            return None
+        try:
+            data = json.loads(line)
+        except json.decoder.JSONDecodeError as err:
+            print("Error json decoding", err)
+            print("  line:", line)
+            return None
+
+        return self.emit(data)
+
+    def emit(self, data):
+        """
+        Make an event from a decoded message, and call subscribers
+        Returns the event
+        """
+        event = EVENT_TYPES.get(data.get("message_type", None), Unknown_Event)(data)
+        for callback in self.subscribers.get(event.message_type, []):
+            callback(event)
+        return event
+
+
+class Console_Renderer:
+    """
+    Show restic progress on one console line
+    The line is updated at most once every interval seconds
+    With a Progress, throughput and ETA for the item and all hosts are shown
+    """
+    def __init__(self, stream, interval=1.0, progress=None, item=None):
+        self.interval = interval
+        self.last = 0
+        self.progress = progress    # Optional Progress, show throughput and ETA
+        self.item = item
+        self.active = citobackup_util.write_console
+        if self.active:
+            stream.subscribe("status", self.status)
+
+    def status(self, event):
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        if self.progress:
+            print("\r%s\033[K" % self.progress.status_line(self.item), end="")
+            sys.stdout.flush()
+            return
+        s = ""
+        if "seconds_elapsed" in event:
+            s += "Seconds elapsed: %i" % event["seconds_elapsed"]
+        if "percent_done" in event:
+            s += ", Percent done: %i" % (event["percent_done"] * 100)
+        if "files_done" in event:
+            s += ", Files done: %i" % event["files_done"]
+        print("\r%s\033[K" % s, end="")
+        sys.stdout.flush()
+
+    def close(self):
+        if self.active:
+            print("\r%s\033[K" % "", end="")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Backup metrics in OpenMetrics text format
+
+The metrics are written to a file read by the textfile collector of the
+Prometheus node_exporter. They are made from the history database, with the
+last backup of each host, so a backup of some hosts keeps the metrics of the
+others.
+"""
+
+import os
+
+
+# Metrics of each item, and sum over all items of a host
+# name, help, column in history results
+ITEM_METRICS = [
+    ["duration_seconds", "Duration of last backup", "total_duration"],
+    ["processed_bytes", "Bytes read in last backup", "total_bytes_processed"],
+    ["added_bytes", "Bytes added to the repository in last backup", "data_added"],
+    ["files_new", "New files in last backup", "files_new"],
+    ["files_changed", "Changed files in last backup", "files_changed"],
+    ["errors", "Errors in last backup", "error_count"],
+    ["last_success_timestamp_seconds", "Time of last successful backup", "last_success"],
+]
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Metric families in OpenMetrics text format, all gauges
+    """
+    def __init__(self, prefix="citobackup"):
+        self.prefix = prefix
+        self.families = {}  # name -> [help, samples]
+
+    def add(self, name, help, labels, value):
+        if value is None:
+            return
+        family = self.families.setdefault(self.prefix + "_" + name, [help, []])
+        label_txt = ",".join('%s="%s"' % (k, escape(v)) for k, v in labels.items())
+        family[1].append("%s{%s} %s" % (self.prefix + "_" + name, label_txt, repr(float(value))))
+
+    def __str__(self):
+        lines = []
+        for name, (help, samples) in self.families.items():
+            lines.append("# TYPE %s gauge" % name)
+            if name.endswith("_seconds"):
+                lines.append("# UNIT %s seconds" % name)
+            elif name.endswith("_bytes"):
+                lines.append("# UNIT %s bytes" % name)
+            lines.append("# HELP %s %s" % (name, help))
+            lines += samples
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def backup_metrics(results, phases):
+    """
+    Return Metrics for results of the last backup of each host
+    results, rows from History.latest_results()
+    phases, {result_id: {phase: seconds}}
+
+    Items are labeled with their position in the host backup, as two items
+    can have the same name and type, and node_exporter rejects a file with
+    duplicate series
+    """
+    metrics = Metrics()
+    hosts = {}
+    for row in results:
+        if row["name"] == "" and row["backup_type"] == "":
+            # Hostname row, with phases of the host and errors outside items
+            host = hosts.setdefault(row["hostname"], {})
+            host["row"] = row
+            host["error_count"] = host.get("error_count", 0) + row["error_count"]
+            continue
+
+        host = hosts.setdefault(row["hostname"], {})
+        host["items"] = host.get("items", 0) + 1
+        labels = {
+            "host": row["hostname"],
+            "index": host["items"],
+            "item": row["name"],
+            "subitem": row["subname"],
+            "type": row["backup_type"],
+        }
+        for name, help, column in ITEM_METRICS:
+            metrics.add("item_" + name, help, labels, row[column])
+        for phase, seconds in sorted(phases.get(row["id"], {}).items()):
+            metrics.add("item_phase_duration_seconds", "Duration of a phase of last backup",
+                        dict(labels, phase=phase), seconds)
+
+        for name, help, column in ITEM_METRICS:
+            if column not in ["total_duration", "last_success"]:
+                host[column] = host.get(column, 0) + (row[column] or 0)
+
+    for hostname, host in sorted(hosts.items()):
+        labels = {"host": hostname}
+        row = host.get("row", None)
+        for name, help, column in ITEM_METRICS:
+            if column in ["total_duration", "last_success"]:
+                value = row[column] if row is not None else None
+            else:
+                value = host.get(column, 0)
+            metrics.add("host_" + name, help, labels, value)
+        if row is not None:
+            metrics.add("host_last_run_timestamp_seconds", "Time of last backup", labels, row["started"])
+            for phase, seconds in sorted(phases.get(row["id"], {}).items()):
+                metrics.add("host_phase_duration_seconds", "Duration of a phase of last backup",
+                            dict(labels, phase=phase), seconds)
+    return metrics
+
+
+def write_textfile(filename, txt):
+    """
+    Write metrics atomically, node_exporter never reads a partial file
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with open(tmpfile, "w") as f:
+            f.write(txt)
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, filename)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+
+if __name__ == "__main__":
+    # function test, items with the same name and type must give separate series
+    import tempfile
+    import citobackup_db
+    import citobackup_util
+    with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+        history = citobackup_db.History(f.name)
+        run_id = history.start_run("backup")
+        results = citobackup_util.Backup_Results()
+        r = citobackup_util.Backup_Result()
+        r.total_duration = 60
+        r.add_phase("connect", 1.5)
+        results.add(r)
+        for name, subname, backup_type in [["Wordpress site", "www", "wordpress"], ["Wordpress site", "www", "wordpress"],
+                                           ["", "", "files"], ["", "", "files"], ["etc", "", "files"]]:
+            r = citobackup_util.Backup_Result()
+            r.name = name
+            r.subname = subname
+            r.backup_type = backup_type
+            r.snapshot_id = "abcd1234"
+            r.add_phase("restic", 2.5)
+            results.add(r)
+        history.add_results(run_id, "host1", results)
+        history.finish_run(run_id)
+        rows = history.latest_results()
+        txt = str(backup_metrics(rows, history.phases(row["id"] for row in rows)))
+        history.close()
+    print(txt)
+    series = [line.rsplit(" ", 1)[0] for line in txt.splitlines() if not line.startswith("#")]
+    duplicates = set(s for s in series if series.count(s) > 1)
+    assert not duplicates, "duplicate series: %s" % duplicates
+    assert 'citobackup_host_duration_seconds{host="host1"} 60.0' in txt
+    assert 'citobackup_host_phase_duration_seconds{host="host1",phase="connect"} 1.5' in txt
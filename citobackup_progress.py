@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and ETA for running backups
+
+restic status messages has bytes_done (bytes_restored for restore) and
+total_bytes. Each running restic is tracked as an item, with throughput over
+a sliding window. Items are combined per host and for all hosts.
+"""
+
+import collections
+import threading
+import time
+
+
+WINDOW = 30     # Seconds, throughput is calculated over this window
+
+MB = 1000 * 1000
+
+
+class Item_Progress:
+    """
+    Progress for one running restic
+    """
+    def __init__(self, hostname, name, window=WINDOW):
+        self.hostname = hostname
+        self.name = name
+        self.window = window
+
+        self.samples = collections.deque()  # (time, bytes_done)
+        self.started = time.monotonic()
+        self.bytes_done = 0
+        self.total_bytes = 0
+        self.percent_done = 0
+        self.seconds_elapsed = 0
+        self.peak = 0           # Highest throughput over the window, bytes/s
+
+    def update(self, event):
+        """
+        Called with each restic status event
+        """
+        now = time.monotonic()
+        self.bytes_done = event.get("bytes_done", event.get("bytes_restored", self.bytes_done))
+        self.total_bytes = event.get("total_bytes", self.total_bytes)
+        self.percent_done = event.get("percent_done", self.percent_done)
+        self.seconds_elapsed = event.get("seconds_elapsed", self.seconds_elapsed)
+
+        self.samples.append((now, self.bytes_done))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+        throughput = self.throughput()
+        if throughput > self.peak and now - self.samples[0][0] >= 1:
+            self.peak = throughput
+
+    def throughput(self):
+        """
+        Return bytes/s over the sliding window
+        """
+        if len(self.samples) < 2:
+            return 0
+        t0, b0 = self.samples[0]
+        t1, b1 = self.samples[-1]
+        if t1 <= t0:
+            return 0
+        return max(0, b1 - b0) / (t1 - t0)
+
+    def average(self):
+        """
+        Return bytes/s since start
+        """
+        elapsed = self.seconds_elapsed or (time.monotonic() - self.started)
+        if elapsed <= 0:
+            return 0
+        return self.bytes_done / elapsed
+
+    def eta(self):
+        """
+        Return estimated seconds left, None if unknown
+        """
+        throughput = self.throughput()
+        if not throughput or self.total_bytes <= self.bytes_done:
+            return None
+        return (self.total_bytes - self.bytes_done) / throughput
+
+
+class Progress:
+    """
+    Progress of all running backups
+    Items are started and finished from several threads
+    """
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.items = []
+
+    def start(self, hostname, name):
+        """
+        Start tracking a restic run, returns the Item_Progress
+        """
+        item = Item_Progress(hostname, name, window=self.window)
+        with self.lock:
+            self.items.append(item)
+        return item
+
+    def finish(self, item):
+        """
+        Stop tracking a restic run
+        """
+        with self.lock:
+            if item in self.items:
+                self.items.remove(item)
+
+    def hosts(self):
+        """
+        Return dict hostname -> [throughput bytes/s, bytes left, running items]
+        """
+        res = {}
+        with self.lock:
+            items = list(self.items)
+        for item in items:
+            host = res.setdefault(item.hostname, [0, 0, 0])
+            host[0] += item.throughput()
+            host[1] += max(0, item.total_bytes - item.bytes_done)
+            host[2] += 1
+        return res
+
+    def fleet(self, hosts=None):
+        """
+        Return [throughput bytes/s, bytes left, running items] for all hosts
+        hosts, optional result from hosts()
+        """
+        if hosts is None:
+            hosts = self.hosts()
+        res = [0, 0, 0]
+        for throughput, left, count in hosts.values():
+            res[0] += throughput
+            res[1] += left
+            res[2] += count
+        return res
+
+    def status_line(self, item=None):
+        """
+        Return one line with progress, for the console
+        """
+        s = ""
+        if item:
+            s += "Seconds elapsed: %i" % item.seconds_elapsed
+            s += ", Percent done: %i" % (item.percent_done * 100)
+            s += ", %.1f MB/s" % (item.throughput() / MB)
+            eta = item.eta()
+            if eta is not None:
+                s += ", ETA %is" % eta
+        hosts = self.hosts()
+        if item and item.hostname in hosts:
+            throughput, left, count = hosts[item.hostname]
+            if count > 1:
+                s += " | %s: %i running, %.1f MB/s" % (item.hostname, count, throughput / MB)
+                if throughput and left:
+                    s += ", ETA %is" % (left / throughput)
+        if len(hosts) > 1:
+            throughput, left, count = self.fleet(hosts)
+            s += " | %i hosts, %i running, %.1f MB/s total" % (len(hosts), count, throughput / MB)
+            if throughput and left:
+                s += ", ETA %is" % (left / throughput)
+        return s
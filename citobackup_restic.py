@@ -4,18 +4,40 @@
 Manage restic, using the CLI
 """
 
+import concurrent.futures
+import fnmatch
+import glob
+import hashlib
 import json
+import os
+import re
+import shlex
+import shutil
+import threading
+import time
 import yaml
 import traceback
 
+import citobackup_metrics
 import citobackup_util
-from citobackup_ssh import SSH
+from citobackup_cache import Repo_Cache
+from citobackup_db import History, Path_Index
+from citobackup_events import Event_Stream, Console_Renderer, STATUS_INTERVAL
+from citobackup_progress import Progress, MB
+from citobackup_ssh import SSH, TUNNEL_PORT
 
 
 # ----- globals --------------------------------------------------------
 
 backup_results = []
 
+SSH_CONFIG_TEMPLATE = "/opt/citobackup/remote/ssh-config"
+SPARSE_CAT = "/opt/citobackup/remote/sparse-cat.py"   # Copied to ESXi hosts
+SSH_HOST_KEYS = "/etc/ssh/ssh_host_*_key.pub"    # Our sshd keys, restic connects to these
+BOOTSTRAP_FINGERPRINT = ".ssh/citobackup-fingerprint"
+
+RESTIC_BINARY = "/opt/restic/restic"    # restic, on backup server and remote hosts
+
 # ----------------------------------------------------------------------
 
 
@@ -28,6 +50,101 @@ class Restic:
         self.config = config
         self.backups = backups
 
+        self.lock = threading.Lock()
+        self.binary = None          # pinned restic binary, [path, sha256, version]
+        self.remote_binary = {}     # hostname -> restic binary on remote host
+        self.progress = Progress()  # Throughput of running backups
+
+        # Check the configuration, overridden tunnel ports must be unique
+        if backups is not None:
+            self.tunnel_ports()
+
+        # Timeouts for all commands, local and on remote hosts
+        timeouts = config.get("timeouts", None) or {}
+        if timeouts.get("command", None):
+            citobackup_util.cmd_timeout = float(timeouts["command"])
+        if timeouts.get("idle", None):
+            citobackup_util.cmd_idle_timeout = float(timeouts["idle"])
+
+    def restic_binary(self):
+        """
+        Return the pinned restic binary as [path, sha256, version]
+
+        The binary in the configuration (restic.binary) is copied to a content
+        addressed local cache. All commands in a run use the same version, even
+        if the configured file is replaced while running.
+        """
+        with self.lock:
+            if self.binary is None:
+                try:
+                    binary = self.config.restic.binary
+                except AttributeError:
+                    binary = RESTIC_BINARY
+                sha256 = citobackup_util.sha256_file(binary)
+                path = citobackup_util.cache_file("restic", sha256, "restic")
+                if not os.path.exists(path):
+                    shutil.copyfile(binary, path + ".tmp")
+                    os.chmod(path + ".tmp", 0o755)
+                    os.replace(path + ".tmp", path)
+                r, txt = citobackup_util.run_cmd([path, "version"])
+                self.binary = [path, sha256, txt.strip()]
+            return self.binary
+
+    def local_restic(self):
+        """
+        Return path to restic binary used on the backup server
+        """
+        return self.restic_binary()[0]
+
+    def remote_restic(self, remote_srv):
+        """
+        Return path to restic binary used on remote host
+        """
+        return self.remote_binary.get(remote_srv.hostname, RESTIC_BINARY)
+
+    def remote_restic_path(self):
+        """
+        Return path on remote hosts where the pinned binary is installed
+        None if the binary is not managed, the installed /opt/restic/restic is used
+        """
+        try:
+            remote_dir = self.config.restic.remote_dir
+        except AttributeError:
+            return None
+        path, sha256, version = self.restic_binary()
+        return "%s/restic-%s" % (remote_dir, sha256[:16])
+
+    def install_restic(self, remote_srv, state):
+        """
+        Make sure remote host runs the pinned restic binary
+        state, the sha256 and version of the remote binary, from bootstrap_host()
+
+        If restic.remote_dir is configured, the binary is copied to a content
+        addressed file in that directory, unless it is already there. Otherwise
+        the remote /opt/restic/restic is used, and a version mismatch is reported.
+        """
+        path, sha256, version = self.restic_binary()
+        remote_path = self.remote_restic_path()
+        if state.get("restic_sha256", "") == sha256:
+            self.remote_binary[remote_srv.hostname] = remote_path or RESTIC_BINARY
+            return
+
+        if remote_path is None:
+            print("Warning: remote restic differs from %s" % path)
+            print("  local : %s" % version)
+            print("  remote: %s" % (state.get("restic_version", "") or "not found"))
+            return
+
+        print("Copying %s to %s" % (version, remote_path))
+        remote_srv.scp(local=path, remote=remote_path + ".tmp", mode="755")
+        remote_srv.ssh(["mv", "-f", remote_path + ".tmp", remote_path])
+
+        # restic needs to read all files. This works if citobackup is allowed to run setcap with sudo
+        txt = remote_srv.ssh("sudo -n /sbin/setcap cap_dac_read_search=+ep %s && echo setcap_ok" % remote_path)
+        if "setcap_ok" not in txt:
+            print("Warning: could not set capabilities on %s, restic can only read files readable by citobackup" % remote_path)
+        self.remote_binary[remote_srv.hostname] = remote_path
+
     def print_header(self, msg):
         print()
         print("\u250c%s\u2510" % ("\u2500" * (len(msg) + 2)))
@@ -54,44 +171,121 @@ class Restic:
         print("  total_duration        :", r.get("total_duration", ""))
         print("  snapshot_id           :", r.get("snapshot_id", ""))
 
+    def run_backup(self, remote_srv, cmd, results=None, stream=None, phase=True):
+        """
+        Run restic backup or restore on remote host, with json output
+        Progress is shown on the console while restic runs
+        results, list of Backup_Result, gets the average and peak throughput
+        stream, optional Event_Stream with more subscribers
+        phase, add the restic time to the phases of the result. False if the
+        caller sets it, as split_backup_output does
+        Returns list of error and summary events
+        """
+        name = ""
+        if results:
+            name = " ".join(t for t in [results[0].name, results[0].subname] if t)
+        item = self.progress.start(remote_srv.hostname, name)
+        if stream is None:
+            stream = Event_Stream(status_interval=STATUS_INTERVAL)
+        stream.subscribe("status", item.update)
+        renderer = Console_Renderer(stream, progress=self.progress, item=item)
+        start = time.monotonic()
+        try:
+            return remote_srv.ssh(cmd, decode_json=True, stream=stream)
+        finally:
+            renderer.close()
+            print()
+            self.progress.finish(item)
+            for result in results or []:
+                result.mbps_avg = item.average() / MB
+                result.mbps_peak = item.peak / MB
+            if results and phase:
+                results[0].add_phase("restic", time.monotonic() - start)
+
     def add_backup_output(self, output=None, result=None):
         """
         in
-          output, text from restic json outpt
+          output, events from restic json output
           result, collects backup result
         """
         for r in output:
-            if "message_type" in r:
-                if r["message_type"] == "error":
-                    try:
-                        msg = print("Error %s(%s): %s" % (r["error"]["Op"], r["error"]["Err"], r["item"]))
-                    except KeyError as err:
-                        msg = f"Unknown error: {err}"
-                    result.add_error(msg)
-                elif r["message_type"] == "summary":
-                    self.backup_print_summary(r)
-                    result.files_new = r["files_new"]
-                    result.files_changed = r["files_changed"]
-                    result.files_unmodified = r["files_unmodified"]
-                    result.dirs_new = r["dirs_new"]
-                    result.dirs_changed = r["dirs_changed"]
-                    result.dirs_unmodified = r["dirs_unmodified"]
-                    result.total_files_processed = r["total_files_processed"]
-                    result.total_bytes_processed = r["total_bytes_processed"]
-                    result.total_duration = r["total_duration"]
-                    result.snapshot_id = r["snapshot_id"]
-
-                    # Data from stdin, total_bytes_processed is zero
-                    data_added = r.get("data_added", None)
-                    if data_added > 0 and result.total_bytes_processed == 0:
-                        result.total_bytes_processed = data_added
-                    
-    def backup_docker_compose(self, remote_srv, src, results=None, name=None, subname=None):
+            if r.message_type == "error":
+                msg = r.msg
+                print(msg)
+                result.add_error(msg)
+            elif r.message_type == "summary":
+                self.backup_print_summary(r)
+                result.files_new = r["files_new"]
+                result.files_changed = r["files_changed"]
+                result.files_unmodified = r["files_unmodified"]
+                result.dirs_new = r["dirs_new"]
+                result.dirs_changed = r["dirs_changed"]
+                result.dirs_unmodified = r["dirs_unmodified"]
+                result.total_files_processed = r["total_files_processed"]
+                result.total_bytes_processed = r["total_bytes_processed"]
+                result.total_duration = r["total_duration"]
+                result.snapshot_id = r["snapshot_id"]
+                result.data_added = r.get("data_added", 0)
+
+                # Data from stdin, total_bytes_processed is zero
+                data_added = r.get("data_added", 0)
+                if data_added > 0 and result.total_bytes_processed == 0:
+                    result.total_bytes_processed = data_added
+
+    def docker_compose_volumes(self, remote_srv, src):
+        """
+        Read and parse the docker-compose file in src, and find the named volumes
+        Returns list of [volume name, path on host], None if there is no compose file
         """
-        Open and parse the docker-compose.yaml file
-        backup database and configuration files
+        q = shlex.quote
+        cmd = "cd %s && for f in docker-compose.yaml docker-compose.yml compose.yaml compose.yml;" % q(src)
+        cmd += ' do if [ -f "$f" ]; then echo compose_file_ok; cat "$f"; break; fi; done'
+        txt = remote_srv.ssh(cmd)
+        if "compose_file_ok" not in txt:
+            return None
+        dc = yaml.safe_load(txt.split("compose_file_ok", 1)[1])
+
+        basename = src.rstrip("/").split("/")[-1]
+        volume_names = []
+        volumes = dc.get("volumes", None) or {}
+        for volume, volume_config in volumes.items():
+            volume_config = volume_config or {}
+            if volume_config.get("name", None):
+                volume_names.append(volume_config["name"])
+            elif volume_config.get("external", False):
+                volume_names.append(volume)
+            else:
+                volume_names.append(f"{basename}_{volume}")
+        if not volume_names:
+            return []
+
+        # Find where the volumes are on the host
+        cmd = ["docker", "volume", "inspect", "-f", "'{{.Name}} {{.Mountpoint}}'"] + volume_names
+        txt = remote_srv.ssh(cmd)
+        mountpoints = {}
+        for line in txt.split("\n"):
+            tmp = line.split()
+            if len(tmp) == 2:
+                mountpoints[tmp[0]] = tmp[1]
+
+        res = []
+        for volume_name in volume_names:
+            # Backup the volume directory, not only _data
+            path = mountpoints.get(volume_name, f"/var/lib/docker/volumes/{volume_name}/_data")
+            if path.endswith("/_data"):
+                path = path[:-len("/_data")]
+            res.append([volume_name, path])
+        return res
+
+    def backup_docker_compose(self, remote_srv, src, results=None, name=None, subname=None):
         """
+        Backup a docker-compose project directory, and its named volumes
 
+        The docker-compose file is parsed and the volumes found before the
+        services are stopped. While stopped, the project directory and the volumes
+        are backed up in one restic run, and the services are started directly
+        after. The downtime is measured and reported.
+        """
         result = citobackup_util.Backup_Result()
         result.name = name
         result.subname = ""
@@ -99,70 +293,75 @@ class Restic:
         result.include_stat = False
         results.add(result)
 
+        volumes = self.docker_compose_volumes(remote_srv, src)
+        if volumes is None:
+            print("Error: cannot find docker-compose.yaml file")
+            result.add_error("Cannot find docker-compose.yaml file in %s" % src)
+            volumes = []
+
+        item_src = [[src]]
+        item_result = []
+        tmp = citobackup_util.Backup_Result()
+        tmp.name = ""
+        tmp.subname = src
+        tmp.backup_type = "files"
+        item_result.append(tmp)
+        for volume_name, path in volumes:
+            print("backing up volume", volume_name)
+            item_src.append([path])
+            tmp = citobackup_util.Backup_Result()
+            tmp.name = ""
+            tmp.subname = volume_name
+            tmp.backup_type = "Volume"
+            item_result.append(tmp)
+
         self.print_subheader(f"Stop {name}")
+        start = time.monotonic()
         cmd = f"cd {src}; docker-compose stop"
         output = remote_srv.ssh(cmd)
         print("output", output)
-
-        self.backup_files(remote_srv, [src], results=results, name="", subname=src, tags=[name])
-
-        # Get the docker-compose.yaml file
-        dc_file = f"{src}/docker-compose.yaml"
-        if not remote_srv.file_exists(dc_file):
-            dc_file = f"{src}/docker-compose.yml"
-        if not remote_srv.file_exists(dc_file):
-            print("Error: cannot find docker-compose.yaml file")
-            return
-        
-        dc_content = remote_srv.read_from_file(dc_file)
-        dc = yaml.safe_load(dc_content)
-
-        basename = src.split("/")[-1]
-        volumes = dc.get("volumes", None)
-        if volumes:
-            for volume in volumes.keys():
-                volume_name = f"{basename}_{volume}"
-                print("backing up volume", volume_name)
-
-                if 1:
-                    # Ugly, copy volume directly from filesystem, until we find a better
-                    # way to handle named volumes
-                    # Host now have the volume files in /tmp/citobackup/{volume_name}, backup the files
-                    src2 = f"/var/lib/docker/volumes/{volume_name}"
-                    self.backup_files(remote_srv, [src2], results=results, name="", subname=volume_name, tags=[name, f"Volume {volume_name}"], backup_type="Volume")
-
-                else:
-                    # Start a container, mounting the volume
-                    cmd = f"docker container run --rm --name citobackup-alpine -v {volume_name}:/mnt/{volume_name}:ro -v /tmp/citobackup:/mnt:ro -dit alpine /bin/ash"
-                    print("cmd", cmd)
-                    output = remote_srv.ssh(cmd.split(" "))
-                    print("output", output)
-
-                    # Host now have the volume files in /tmp/citobackup/{volume_name}, backup the files
-                    src2 = f"/tmp/citobackup/{volume_name}"
-                    self.backup_files(remote_srv, [src2], results=results, name="", subname=f"Volume {volume_name}", tags=[name, f"Volume {volume_name}"])
-
-                    # Stop the container
-                    # cmd = f"docker attach {container_id} ; exit"
-                    cmd = "docker stop citobackup-alpine"
-                    print("cmd", cmd)
-                    output = remote_srv.ssh(cmd.split(" "))
-                    print("output", output)
-
-                    cmd = "fdocker rm {container_id}"
-                    print("cmd", cmd)
-                    output = remote_srv.ssh(cmd.split(" "))
-                    print("output", output)
-
-                    cmd = "docker ps | grep citobackup"
-                    print("cmd", cmd)
-                    output = remote_srv.ssh(cmd.split(" "))
-                    print("output", output)
-
-        self.print_subheader(f"Start {name}")
-        cmd = f"cd {src}; docker-compose start"
-        output = remote_srv.ssh(cmd)
-        print("output", output)
+        try:
+            tags = [name] + [f"Volume {volume_name}" for volume_name, path in volumes]
+            self.backup_split(remote_srv, item_src, item_result, tags=tags)
+        finally:
+            self.print_subheader(f"Start {name}")
+            cmd = f"cd {src}; docker-compose start"
+            output = remote_srv.ssh(cmd)
+            print("output", output)
+            result.downtime = time.monotonic() - start
+            print("Downtime %.1f seconds" % result.downtime)
+
+        for tmp in item_result:
+            results.add(tmp)
+
+    def esxi_vm(self, remote_srv, vim_cmd, vm):
+        """
+        Find a VM on ESXi host
+        Returns (vmid, datastore, vmx path in datastore), None if not found
+        """
+        txt = remote_srv.ssh([vim_cmd, "vmsvc/getallvms"])
+        for line in txt.split("\n"):
+            m = re.match(r"^(\d+)\s+(.+?)\s+\[(.+?)\]\s+(.+?\.vmx)\s", line + " ")
+            if m and m.group(2) == vm:
+                return m.group(1), m.group(3), m.group(4)
+        return None
+
+    def esxi_snapshots(self, remote_srv, vim_cmd, vmid, snapshot_name):
+        """
+        Return list of ids of VM snapshots named snapshot_name, all snapshots
+        if snapshot_name is None
+        """
+        txt = remote_srv.ssh([vim_cmd, "vmsvc/snapshot.get", vmid])
+        ids = []
+        name = None
+        for line in txt.split("\n"):
+            key, sep, value = line.partition(":")
+            key = key.strip("- ")
+            if key == "Snapshot Name":
+                name = value.strip()
+            elif key == "Snapshot Id" and snapshot_name in [None, name]:
+                ids.append(value.strip())
+        return ids
 
     def backup_esxi(self, remote_srv, src, results=None, name=None, subname=None):
         """
@@ -182,32 +381,131 @@ class Restic:
         during snapshot
         *-flat.vmdk
 
+        The -flat.vmdk files are streamed to restic with sparse-cat.py, holes
+        in thin provisioned disks are not read.
+
+        src settings, vm is mandatory
+          vm              name of the VM
+          vim_cmd         default /bin/vim-cmd
+          datastore_root  default /vmfs/volumes
+          python          default python, python on ESXi host
         """
+        vm = src["vm"]
+        vim_cmd = src.get("vim_cmd", "/bin/vim-cmd")
+        datastore_root = src.get("datastore_root", "/vmfs/volumes").rstrip("/")
+        python = src.get("python", "python")
+        self.print_subheader("Backup ESXi VM %s" % vm)
+
         result = citobackup_util.Backup_Result()
         result.name = name
         result.subname = subname
         result.backup_type = "esxi"
+        result.include_stat = False
+        results.add(result)
 
         # vim-cmd vmsvc/getallvms
         #    parse out the vm id
+        tmp = self.esxi_vm(remote_srv, vim_cmd, vm)
+        if tmp is None:
+            result.add_error("Can't find VM %s" % vm)
+            print("Error: can't find VM %s" % vm)
+            return
+        vmid, datastore, vmx = tmp
+        vmdir = "%s/%s/%s" % (datastore_root, datastore, os.path.dirname(vmx))
 
         # Check if there is an old snapshot from previous backups, if so remove it
         # and send notify, last backup wasn't 100% correct
-        # vim-cmd vmsvc/snapshot.remove <id>
+        for snapshot_id in self.esxi_snapshots(remote_srv, vim_cmd, vmid, "citobackup"):
+            print("Removing old snapshot %s" % snapshot_id)
+            result.add_error("Snapshot from previous backup was not removed")
+            remote_srv.ssh([vim_cmd, "vmsvc/snapshot.remove", vmid, snapshot_id])
 
         # Copy files, we do this before snapshot, so there is no mentioning of the
         # snapshot in these files. It makes restore easier.
         #    .vmx .nvram .vmsd .vmdk
-        #
-        # create snapshot
-        # vim-cmd vmsvc/snapshot.create <id> backup backup-snapshot 0 0
-
-        # copy the virtual disk, it is now in read-only
-        #
-        # delete the snapshot
-        # vim-cmd vmsvc/snapshot.remove <id>
+        files = remote_srv.ssh(["ls", "-1", shlex.quote(vmdir)]).split("\n")
+        config_files = []
+        disks = []
+        for filename in files:
+            filename = filename.strip()
+            if filename.endswith("-flat.vmdk"):
+                disks.append(filename)
+            elif re.search(r"-(delta|sesparse|ctk|\d{6})\.vmdk$", filename):
+                continue
+            elif re.search(r"\.(vmx|vmxf|nvram|vmsd|vmdk)$", filename):
+                config_files.append("%s/%s" % (vmdir, filename))
+        if config_files:
+            self.backup_files(remote_srv, config_files, results=results, name=name, subname=vm,
+                              tags=[name, vm], backup_type="esxi-config")
+
+        # With other snapshots, the current disk content is in delta files, the
+        # -flat.vmdk files are old
+        if self.esxi_snapshots(remote_srv, vim_cmd, vmid, None):
+            result.add_error("VM %s has snapshots, disks not backed up. Remove the snapshots" % vm)
+            print("Error: VM %s has snapshots, disks not backed up" % vm)
+            return
 
-        results.add(result)
+        # create snapshot, if the VM is running
+        txt = remote_srv.ssh([vim_cmd, "vmsvc/power.getstate", vmid])
+        running = "Powered on" in txt
+        if running:
+            print("Creating snapshot")
+            txt = remote_srv.ssh([vim_cmd, "vmsvc/snapshot.create", vmid, "citobackup", "citobackup-snapshot", "0", "0"])
+            if not self.esxi_snapshots(remote_srv, vim_cmd, vmid, "citobackup"):
+                print(txt)
+                result.add_error("Snapshot of VM %s failed, disks not backed up" % vm)
+                print("Error: snapshot of VM %s failed" % vm)
+                return
+
+        # copy the virtual disks, they are now in read-only
+        sparse_cat = None
+        cmdfile = None
+        try:
+            sparse_cat = remote_srv.tmpname("sparse-cat.py")
+            remote_srv.scp(local=SPARSE_CAT, remote=sparse_cat)
+            for disk in disks:
+                self.print_subheader("Backup disk %s" % disk)
+                disk_result = citobackup_util.Backup_Result()
+                disk_result.name = name
+                disk_result.subname = "%s/%s" % (vm, disk)
+                disk_result.backup_type = "esxi-disk"
+
+                # No pipefail in the ESXi shell, exit code of sparse-cat is saved in a file
+                status_file = remote_srv.tmpname("sparse-cat.status")
+                cmd = []
+                cmd += ["{", python, sparse_cat, shlex.quote("%s/%s" % (vmdir, disk))]
+                cmd += ["||", "echo", "$?", ">%s;" % shlex.quote(status_file), "}"]
+                cmd += ["|"]
+                cmd += [self.remote_restic(remote_srv)]
+                cmd += ["-r", "sftp:127.0.0.1:%s/%s" % (self.config.default_dest, remote_srv.hostname)]
+                cmd += ["backup"]
+                cmd += ["-p", "/tmp/restic_password.txt"]
+                cmd += ["--stdin"]
+                cmd += ["--stdin-filename", shlex.quote("%s/%s" % (vm, disk))]
+                cmd += ["--json"]
+                cmd += ["--tag", f'"{name}"', "--tag", f'"{vm}"']
+
+                cmdfile = remote_srv.tmpname("esxi_backup.sh")
+                remote_srv.write_to_file(filename=cmdfile, data="#!/bin/sh\n" + " ".join(cmd), mode="700")
+                output = self.run_backup(remote_srv, cmdfile, results=[disk_result])
+                self.add_backup_output(output=output, result=disk_result)
+                status = remote_srv.ssh(["cat", status_file, "2>/dev/null", ";", "rm", "-f", status_file]).strip()
+                if status:
+                    disk_result.add_error("Read of disk %s failed, exit code %s, snapshot %s is incomplete" % (
+                        disk, status, disk_result.snapshot_id or ""))
+                results.add(disk_result)
+                remote_srv.unlink(path=cmdfile)
+                cmdfile = None
+
+        finally:
+            for path in [sparse_cat, cmdfile]:
+                if path:
+                    remote_srv.unlink(path=path)
+            # delete the snapshot
+            if running:
+                for snapshot_id in self.esxi_snapshots(remote_srv, vim_cmd, vmid, "citobackup"):
+                    print("Removing snapshot %s" % snapshot_id)
+                    remote_srv.ssh([vim_cmd, "vmsvc/snapshot.remove", vmid, snapshot_id])
 
     def backup_files(self, remote_srv, src, results=None, name=None, subname=None, tags=None, backup_type="files"):
         """
@@ -227,32 +525,327 @@ class Restic:
 
         # Write and copy list of files to backup if more than one file
         if len(src) > 1:
-            remote_srv.write_to_file(filename="/tmp/backup_list", data="\n".join(src))
+            backup_list = remote_srv.tmpname("backup_list")
+            remote_srv.write_to_file(filename=backup_list, data="\n".join(src))
 
         # Run backup
         cmd = []
-        cmd += ["/opt/restic/restic"]
+        cmd += [self.remote_restic(remote_srv)]
         cmd += ["-r", "sftp:127.0.0.1:%s/%s" % (self.config.default_dest, remote_srv.hostname)]
         cmd += ["backup"]
         cmd += ["-p", "/tmp/restic_password.txt"]
         cmd += ["--one-file-system"]
         cmd += ["--json"]
         if len(src) > 1:
-            cmd += ["--files-from", "/tmp/backup_list"]
+            cmd += ["--files-from", backup_list]
         else:
             cmd += [src[0]]
         if tags:
             for tag in tags:
                 cmd += ["--tag", f'"{tag}"']
         print(" ".join(cmd))
-        output = remote_srv.ssh(cmd, decode_json=True)
+        output = self.run_backup(remote_srv, cmd, results=[result])
         self.add_backup_output(output=output, result=result)
         results.add(result)
 
+    def backup_files_coalesced(self, remote_srv, items, results=None):
+        """
+        Backup all files items on a host, in one restic run
+        Saves the per run overhead in restic, loading the index, locking and
+        writing a snapshot.
+
+        items is a list of [backup2, name, subname], results a list with one
+        Backup_Results for each item.
+        """
+        self.print_subheader("Backup files, %d items in one run" % len(items))
+
+        item_src = []
+        item_result = []
+        tags = []
+        for ix, (backup2, name, subname) in enumerate(items):
+            item_src.append(backup2.src)
+            result = citobackup_util.Backup_Result()
+            result.name = name
+            result.subname = subname
+            result.backup_type = "files"
+            item_result.append(result)
+            results[ix].add(result)
+            tag = " ".join(t for t in [name, subname] if t).replace(",", " ")
+            if tag and tag not in tags:
+                tags.append(tag)
+
+        self.backup_split(remote_srv, item_src, item_result, tags=tags)
+
+    def backup_split(self, remote_srv, item_src, item_result, tags=None):
+        """
+        Backup the sources of several items in one restic run
+
+        item_src is a list with the source paths of each item, item_result a
+        list with one Backup_Result for each item. restic only gives a summary
+        for the whole snapshot, so the verbose per file output is used to split
+        the summary into the item results.
+        """
+        # One list with all sources for restic
+        src = []
+        for paths in item_src:
+            for path in paths:
+                print(f"  {path}")
+                if path not in src:
+                    src.append(path)
+        print()
+
+        backup_list = remote_srv.tmpname("backup_list")
+        remote_srv.write_to_file(filename=backup_list, data="\n".join(src))
+
+        # Run backup
+        cmd = []
+        cmd += [self.remote_restic(remote_srv)]
+        cmd += ["-r", "sftp:127.0.0.1:%s/%s" % (self.config.default_dest, remote_srv.hostname)]
+        cmd += ["backup"]
+        cmd += ["-p", "/tmp/restic_password.txt"]
+        cmd += ["--one-file-system"]
+        cmd += ["--json"]
+        cmd += ["--verbose=2"]      # Needed to get status for each file and directory
+        cmd += ["--files-from", backup_list]
+        for tag in tags or []:
+            cmd += ["--tag", f'"{tag}"']
+
+        print(" ".join(cmd))
+        # The per file output is counted as it arrives, it is not kept
+        stream = Event_Stream(status_interval=STATUS_INTERVAL)
+        stream.subscribe("verbose_status", lambda r: self.split_verbose_status(r, item_src, item_result))
+        output = self.run_backup(remote_srv, cmd, results=item_result, stream=stream, phase=False)
+        self.split_backup_output(output=output, item_src=item_src, item_result=item_result)
+
+    def find_item(self, item_src, path):
+        """
+        Return index of the item with the longest source path matching path
+        None if there is none
+        """
+        best_ix = None
+        best_len = -1
+        for ix, src in enumerate(item_src):
+            for s in src:
+                s = s.rstrip("/")
+                if (path == s or path.startswith(s + "/")) and len(s) > best_len:
+                    best_ix = ix
+                    best_len = len(s)
+        return best_ix
+
+    def split_verbose_status(self, r, item_src, item_result):
+        """
+        Account one verbose_status event, a file or directory, to the item
+        with the longest matching source path
+        """
+        item = r.get("item", "")
+        ix = self.find_item(item_src, item.rstrip("/"))
+        if ix is None:
+            # Parent directories of the sources
+            return
+        result = item_result[ix]
+        action = r.get("action", "")
+        if item.endswith("/"):
+            if action == "new":
+                result.dirs_new += 1
+            elif action == "modified":
+                result.dirs_changed += 1
+            elif action == "unchanged":
+                result.dirs_unmodified += 1
+        else:
+            if action == "new":
+                result.files_new += 1
+            elif action == "modified":
+                result.files_changed += 1
+            elif action == "unchanged":
+                result.files_unmodified += 1
+            else:
+                return
+            result.total_files_processed += 1
+            result.total_bytes_processed += r.get("data_size", 0)
+        result.data_added += r.get("data_size_in_repo", 0) + r.get("metadata_size_in_repo", 0)
+
+    def split_backup_output(self, output=None, item_src=None, item_result=None):
+        """
+        Split output from one restic backup run into per item results
+        Files and directories are already counted by split_verbose_status.
+        Errors go to the item with the longest matching source path. The
+        snapshot duration is shared by the items, in proportion to the
+        processed bytes.
+        """
+        summary = None
+        for r in output:
+            message_type = r.message_type
+            if message_type == "summary":
+                summary = r
+                self.backup_print_summary(r)
+
+            elif message_type == "error":
+                msg = r.msg
+                print(msg)
+                ix = self.find_item(item_src, r.get("item", ""))
+                item_result[ix if ix is not None else 0].add_error(msg)
+
+        if summary is None:
+            return
+        total_bytes = sum(result.total_bytes_processed for result in item_result)
+        for result in item_result:
+            result.snapshot_id = summary["snapshot_id"]
+            if total_bytes:
+                result.total_duration = summary["total_duration"] * result.total_bytes_processed / total_bytes
+            else:
+                result.total_duration = summary["total_duration"] / len(item_result)
+            result.add_phase("restic", result.total_duration)
+
+    def database_unchanged(self, remote_srv, db_type, src, fingerprint, results=None, name=None, subname=None):
+        """
+        Check if a database is unchanged since last successful backup
+        If so, a result is added with the snapshot from last backup
+        Returns True if unchanged
+        """
+        if fingerprint is None:
+            return False
+        cache_file = citobackup_util.cache_file("dbstate", "%s.json" % remote_srv.hostname)
+        with self.lock:
+            state = citobackup_util.load_json(cache_file, default={})
+        last = state.get("%s:%s" % (db_type, src["database"]), None)
+        if not last or last["fingerprint"] != fingerprint:
+            return False
+
+        print("Database %s is unchanged since %s, snapshot %s" % (src["database"], last["time"], last["snapshot_id"]))
+        result = citobackup_util.Backup_Result()
+        result.name = name
+        result.subname = subname
+        result.backup_type = db_type
+        result.snapshot_id = last["snapshot_id"]
+        result.unchanged = True
+        results.add(result)
+        return True
+
+    def save_database_fingerprint(self, remote_srv, db_type, src, fingerprint, results):
+        """
+        Save fingerprint of a database, after a successful backup
+        """
+        if fingerprint is None:
+            return
+        for result in results:
+            if result.errors or not result.snapshot_id:
+                return
+        cache_file = citobackup_util.cache_file("dbstate", "%s.json" % remote_srv.hostname)
+        with self.lock:
+            state = citobackup_util.load_json(cache_file, default={})
+            state["%s:%s" % (db_type, src["database"])] = {
+                "fingerprint": fingerprint,
+                "snapshot_id": results[-1].snapshot_id,
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            citobackup_util.save_json(cache_file, state)
+
+    def database_fingerprint(self, remote_srv, script):
+        """
+        Run script on remote host, returns hash of its output
+        The script must print fingerprint_ok last. Returns None on failure
+        """
+        txt = remote_srv.ssh(["bash", "-s"], input=script)
+        if "fingerprint_ok" not in txt:
+            print("Warning: can't check if database has changed")
+            print(txt)
+            return None
+        return hashlib.sha256(txt.encode()).hexdigest()
+
+    def mysql_script_header(self, src):
+        """
+        Return start of a bash script, run with bash -s, for mysql commands
+        The credentials are written to a temporary file, $M runs mysql
+        """
+        script = 'CNF=$(mktemp) || exit 1\n'
+        script += "trap 'rm -f \"$CNF\"' EXIT\n"
+        script += 'cat >"$CNF" <<\'CITOBACKUP_EOF\'\n'
+        script += "[client]\nuser=%s\npassword=%s\n" % (src["username"], src["password"])
+        script += "CITOBACKUP_EOF\n"
+        script += "DB=%s\n" % shlex.quote(src["database"])
+        script += 'M="mysql --defaults-extra-file=$CNF -N -B"\n'
+        return script
+
+    def mysql_fingerprint(self, remote_srv, src):
+        """
+        Return fingerprint of a mysql database, changes when the database changes
+
+        With binary logging the binlog position is used, it moves on every write
+        on the server, together with table sizes and update times. Without binary
+        logging, CHECKSUM TABLE is used on all tables.
+        """
+        script = self.mysql_script_header(src)
+        script += 'POS=$($M -e "SHOW BINARY LOG STATUS" 2>/dev/null || $M -e "SHOW MASTER STATUS") || exit 1\n'
+        script += 'if [ -n "$POS" ]; then\n'
+        script += '    echo "binlog $POS"\n'
+        script += '    $M -e "SELECT COUNT(*), SUM(DATA_LENGTH), SUM(INDEX_LENGTH), MAX(UPDATE_TIME), MAX(CREATE_TIME)'
+        script += ' FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()" "$DB" || exit 1\n'
+        script += "else\n"
+        script += '    TABLES=$($M -e "SET SESSION group_concat_max_len = 10000000;'
+        script += " SELECT GROUP_CONCAT(CONCAT(CHAR(96), TABLE_NAME, CHAR(96))) FROM information_schema.TABLES"
+        script += " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'\" \"$DB\") || exit 1\n"
+        script += '    if [ -n "$TABLES" ] && [ "$TABLES" != "NULL" ]; then\n'
+        script += '        $M -e "CHECKSUM TABLE $TABLES" "$DB" || exit 1\n'
+        script += "    fi\n"
+        script += "fi\n"
+        script += "echo fingerprint_ok\n"
+        return self.database_fingerprint(remote_srv, script)
+
+    def psql_fingerprint(self, remote_srv, src):
+        """
+        Return fingerprint of a postgresql database, changes when the database changes
+
+        The current WAL position is used, it moves on every write to the server,
+        also TRUNCATE, DDL and sequences. Writes to other databases on the
+        server move it too, then the dump is done anyway. Unlogged tables are
+        not in the WAL, if the database has any the fingerprint is always new.
+        """
+        q = shlex.quote
+        script = 'PGPASSFILE=$(mktemp) || exit 1\n'
+        script += "export PGPASSFILE\n"
+        script += "trap 'rm -f \"$PGPASSFILE\"' EXIT\n"
+        script += 'cat >"$PGPASSFILE" <<\'CITOBACKUP_EOF\'\n'
+        script += "%s:*:%s:%s:%s\n" % (src["host"], src["database"], src["username"], src["password"])
+        script += "CITOBACKUP_EOF\n"
+        script += "psql -h %s -U %s -At -c " % (q(src["host"]), q(src["username"]))
+        script += '"SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END,'
+        script += ' pg_postmaster_start_time(),'
+        script += " CASE WHEN EXISTS (SELECT 1 FROM pg_class WHERE relpersistence = 'u') THEN clock_timestamp() END\""
+        script += ' %s || exit 1\n' % q(src["database"])
+        script += "echo fingerprint_ok\n"
+        return self.database_fingerprint(remote_srv, script)
+
     def backup_mysql(self, remote_srv, src, results=None, name=None, subname=None):
         """
         Backup a mysql/mariadb database
+        With skip_unchanged, the dump is skipped if the database is unchanged
+        since last backup. With incremental: binlog, binary logs are backed up
+        between full dumps
+        """
+        if src.get("incremental", None) == "binlog":
+            self.backup_mysql_binlog(remote_srv, src, results=results, name=name, subname=subname)
+            return
+
+        fingerprint = None
+        if src.get("skip_unchanged", False):
+            fingerprint = self.mysql_fingerprint(remote_srv, src)
+            if self.database_unchanged(remote_srv, "mysql", src, fingerprint, results=results, name=name, subname=subname):
+                return
+
+        count = len(results.results)
+        if int(src.get("parallel", 1)) > 1:
+            self.backup_mysql_parallel(remote_srv, src, results=results, name=name, subname=subname)
+        else:
+            self.backup_mysql_stream(remote_srv, src, results=results, name=name, subname=subname)
+        self.save_database_fingerprint(remote_srv, "mysql", src, fingerprint, results.results[count:])
+
+    def backup_mysql_stream(self, remote_srv, src, results=None, name=None, subname=None, binlog_pos_file=None, tags=None):
+        """
+        Backup a mysql/mariadb database, mysqldump is piped to restic
         We don't compress the backup, compression makes dedup very hard
+
+        binlog_pos_file, if set, binary logs are flushed in the dump snapshot,
+        and the binlog position of the dump is written to this remote file
         """
         self.print_subheader("Backup mysql database %s" % src["database"])
         result = citobackup_util.Backup_Result()
@@ -261,16 +854,20 @@ class Restic:
         result.backup_type = "mysql"
 
         # Run backup
-        cmdfile = "/tmp/mysql_backup.sh"
+        cmdfile = remote_srv.tmpname("mysql_backup.sh")
 
         cmd = []
         cmd += ["/usr/bin/mysqldump"]
         cmd += ["--user=%s" % src["username"]]
         cmd += ["--password=%s" % src["password"]]
+        if binlog_pos_file:
+            cmd += ["--single-transaction", "--flush-logs", "--master-data=2"]
         cmd += [src["database"]]
+        if binlog_pos_file:
+            cmd += ["|", "tee", "-p", ">(grep -m1 -E 'CHANGE (MASTER|REPLICATION SOURCE) TO' >%s)" % binlog_pos_file]
         cmd += ["|"]
 
-        cmd += ["/opt/restic/restic"]
+        cmd += [self.remote_restic(remote_srv)]
         cmd += ["-r", "sftp:127.0.0.1:%s/%s" % (self.config.default_dest, remote_srv.hostname)]
         cmd += ["backup"]
         cmd += ["-p", "/tmp/restic_password.txt"]
@@ -278,17 +875,238 @@ class Restic:
         cmd += ["--stdin"]
         cmd += ["--stdin-filename", "%s.mysql.dump" % src["database"]]
         cmd += ["--json"]
+        for tag in tags or []:
+            cmd += ["--tag", f'"{tag}"']
 
         cmd = "#!/bin/bash\n" + " ".join(cmd)
         remote_srv.write_to_file(filename=cmdfile, data=cmd, mode="700")
       
-        output = remote_srv.ssh(cmdfile, decode_json=True)
+        output = self.run_backup(remote_srv, cmdfile, results=[result])
         self.add_backup_output(output=output, result=result)
         results.add(result)
 
         # Cleanup
         # remote_srv.ssh(f"rm {cmdfile}")
 
+    def mysql_binlogs(self, remote_srv, src):
+        """
+        Close the current binary log, and list binary logs on remote host
+        Returns (directory, list of closed binary logs), None if it fails
+        """
+        script = self.mysql_script_header(src)
+        script += '$M -e "FLUSH BINARY LOGS" || exit 1\n'
+        script += 'echo "basename $($M -e "SELECT @@log_bin_basename")"\n'
+        script += '$M -e "SHOW BINARY LOGS" | while read name rest; do echo "binlog $name"; done\n'
+        script += "echo binlogs_ok\n"
+        txt = remote_srv.ssh(["bash", "-s"], input=script)
+        if "binlogs_ok" not in txt:
+            print("Error: can't list binary logs")
+            print(txt)
+            return None
+
+        directory = ""
+        binlogs = []
+        for line in txt.split("\n"):
+            key, sep, value = line.partition(" ")
+            if key == "basename":
+                directory = os.path.dirname(value.strip())
+            elif key == "binlog" and value.strip():
+                binlogs.append(value.strip())
+        # The last binary log is open
+        return directory, sorted(binlogs)[:-1]
+
+    def next_binlog(self, binlog):
+        """
+        Return name of the binary log after binlog, mysql-bin.000009 -> mysql-bin.000010
+        """
+        base, sep, number = binlog.rpartition(".")
+        return "%s.%0*d" % (base, len(number), int(number) + 1)
+
+    def backup_mysql_binlog(self, remote_srv, src, results=None, name=None, subname=None):
+        """
+        Backup a mysql/mariadb database, incremental with binary logs
+
+        A full dump is done every full_every_days days. The binary log position
+        of the dump is saved locally. Between full dumps, the closed binary logs
+        not yet backed up are backed up as files, in one snapshot.
+        Restore: restore the full dump, then replay the binary logs in order from
+        the saved position with mysqlbinlog.
+
+        Binary logging must be enabled, and the mysql user needs the RELOAD and
+        REPLICATION CLIENT privileges.
+        """
+        database = src["database"]
+        full_every_days = float(src.get("full_every_days", 7))
+        cache_file = citobackup_util.cache_file("binlog", "%s.json" % remote_srv.hostname)
+        with self.lock:
+            state = citobackup_util.load_json(cache_file, default={}).get(database, None)
+
+        tmp = self.mysql_binlogs(remote_srv, src)
+        if tmp is None:
+            result = citobackup_util.Backup_Result()
+            result.name = name
+            result.subname = subname
+            result.backup_type = "mysql"
+            result.add_error("Can't list binary logs for database %s" % database)
+            results.add(result)
+            return
+        directory, binlogs = tmp
+
+        # Check if a full dump is needed
+        full = False
+        if state is None:
+            print("No full dump of %s, doing full dump" % database)
+            full = True
+        elif time.time() - state["full_time"] >= full_every_days * 86400:
+            print("Last full dump of %s is older than %s days, doing full dump" % (database, full_every_days))
+            full = True
+        else:
+            expected = state["start_binlog"]
+            if state["last_binlog"]:
+                expected = self.next_binlog(state["last_binlog"])
+            new_binlogs = [b for b in binlogs if b >= expected]
+            if not new_binlogs or new_binlogs[0] != expected:
+                if binlogs and binlogs[-1] >= expected:
+                    print("Binary log %s is missing, doing full dump" % expected)
+                    full = True
+
+        if full:
+            self.print_subheader("Full backup mysql database %s" % database)
+            pos_file = remote_srv.tmpname("binlog_pos")
+            count = len(results.results)
+            self.backup_mysql_stream(remote_srv, src, results=results, name=name, subname=subname,
+                                     binlog_pos_file=pos_file, tags=[database, "full"])
+            txt = remote_srv.read_from_file(pos_file)
+            remote_srv.unlink(path=pos_file)
+            m = re.search(r"_LOG_FILE='([^']+)',\s*\w+_LOG_POS=(\d+)", txt)
+            if len(results.results) == count:
+                return
+            result = results.results[-1]
+            if result.errors or not result.snapshot_id:
+                return
+            if not m:
+                result.add_error("Can't find binary log position in dump of %s" % database)
+                return
+            state = {
+                "full_snapshot": result.snapshot_id,
+                "full_time": time.time(),
+                "start_binlog": m.group(1),
+                "start_pos": int(m.group(2)),
+                "last_binlog": None,
+                "increments": [],
+            }
+        else:
+            self.print_subheader("Incremental backup mysql database %s, binary logs" % database)
+            expected = state["start_binlog"]
+            if state["last_binlog"]:
+                expected = self.next_binlog(state["last_binlog"])
+            new_binlogs = [b for b in binlogs if b >= expected]
+            if not new_binlogs:
+                print("No new binary logs")
+                result = citobackup_util.Backup_Result()
+                result.name = name
+                result.subname = subname
+                result.backup_type = "binlog"
+                result.snapshot_id = state["full_snapshot"]
+                result.unchanged = True
+                results.add(result)
+                return
+            count = len(results.results)
+            tags = [database, "binlog", "full:%s" % state["full_snapshot"]]
+            self.backup_files(remote_srv, ["%s/%s" % (directory, b) for b in new_binlogs],
+                              results=results, name=name, subname=subname, tags=tags, backup_type="binlog")
+            if len(results.results) == count:
+                return
+            result = results.results[-1]
+            if result.errors or not result.snapshot_id:
+                return
+            state["last_binlog"] = new_binlogs[-1]
+            state["increments"].append({
+                "snapshot": result.snapshot_id,
+                "first_binlog": new_binlogs[0],
+                "last_binlog": new_binlogs[-1],
+                "time": time.time(),
+            })
+
+        with self.lock:
+            all_state = citobackup_util.load_json(cache_file, default={})
+            all_state[database] = state
+            citobackup_util.save_json(cache_file, all_state)
+
+    def backup_mysql_parallel(self, remote_srv, src, results=None, name=None, subname=None):
+        """
+        Backup a mysql/mariadb database, dumping tables in parallel
+
+        The tables are dumped to a spool directory on the remote host, one file
+        per table, and the directory is backed up as files. Unchanged tables
+        gives identical files, which dedup well.
+
+        mydumper on the remote host dumps all tables in one consistent
+        snapshot. Without mydumper the item fails, unless per_table_fallback is
+        set. Then each table is dumped with mysqldump --single-transaction, each
+        table is consistent but not across tables, and the result has an error.
+        """
+        database = src["database"]
+        parallel = int(src.get("parallel", 1))
+        spool = src.get("spool", "/var/tmp/citobackup/mysql-%s" % database)
+        per_table_fallback = src.get("per_table_fallback", False)
+        self.print_subheader("Backup mysql database %s, %d tables in parallel" % (database, parallel))
+
+        # Credentials in a file, not on the command line
+        cnf_file = remote_srv.tmpname(".my.cnf", directory="/home/citobackup")
+        cnf = "[client]\nuser=%s\npassword=%s\n" % (src["username"], src["password"])
+        remote_srv.write_to_file(filename=cnf_file, data=cnf, mode="600")
+
+        q = shlex.quote
+        cmd = "#!/bin/bash\n"
+        cmd += "set -o pipefail\n"
+        cmd += "SPOOL=%s\n" % q(spool)
+        cmd += "DB=%s\n" % q(database)
+        cmd += "CNF=%s\n" % q(cnf_file)
+        cmd += 'rm -rf "$SPOOL" && mkdir -p -m 700 "$SPOOL" || exit 1\n'
+        cmd += "if command -v mydumper >/dev/null; then\n"
+        cmd += '    mydumper --defaults-file="$CNF" --database "$DB" --threads %d --trx-consistency-only --outputdir "$SPOOL" || exit 1\n' % parallel
+        if per_table_fallback:
+            cmd += "else\n"
+            cmd += '    echo "dump_per_table: mydumper not found, each table is consistent by itself but not across tables"\n'
+            cmd += '    mysqldump --defaults-extra-file="$CNF" --no-data --routines --triggers --events --skip-dump-date "$DB" >"$SPOOL/$DB-schema.sql" || exit 1\n'
+            cmd += '    mysql --defaults-extra-file="$CNF" -N -B -e "SHOW FULL TABLES WHERE Table_type = \'BASE TABLE\'" "$DB" | cut -f1 |\n'
+            cmd += "        xargs -d '\\n' -P %d -I{} sh -c " % parallel
+            cmd += "'mysqldump --defaults-extra-file=\"$0\" --single-transaction --no-create-info --skip-dump-date \"$1\" \"$2\" >\"$3/$1.$2.sql\"'"
+            cmd += ' "$CNF" "$DB" {} "$SPOOL" || exit 1\n'
+        else:
+            cmd += "else\n"
+            cmd += '    echo "mydumper not found, no consistent dump possible. Install mydumper or set per_table_fallback"\n'
+            cmd += "    exit 1\n"
+        cmd += "fi\n"
+        cmd += "echo dump_ok\n"
+
+        cmdfile = remote_srv.tmpname("mysql_backup.sh")
+        remote_srv.write_to_file(filename=cmdfile, data=cmd, mode="700")
+        start = time.monotonic()
+        txt = remote_srv.ssh(cmdfile)
+        dump_time = time.monotonic() - start
+        print(txt)
+
+        if "dump_ok" in txt:
+            count = len(results.results)
+            self.backup_files(remote_srv, [spool], results=results, name=name, subname=subname,
+                              tags=[database], backup_type="mysql")
+            if "dump_per_table" in txt and len(results.results) > count:
+                results.results[-1].add_error("Dump of database %s is not consistent across tables, mydumper not found" % database)
+        else:
+            result = citobackup_util.Backup_Result()
+            result.name = name
+            result.subname = subname
+            result.backup_type = "mysql"
+            result.add_error("Dump of database %s failed" % database)
+            results.add(result)
+        if results.results:
+            results.results[-1].add_phase("dump", dump_time)
+
+        # Cleanup
+        remote_srv.ssh(["rm", "-rf", spool, cnf_file, cmdfile])
+
     def backup_osticket(self, remote_srv, src, results=None, name=None, subname=None):
         """
         Make a complete backup of osticket, and its mysql database
@@ -323,9 +1141,255 @@ class Restic:
         # Backup the mysql database
         self.backup_mysql(remote_srv, param, results=results)
 
+    def write_pgpass(self, remote_srv, src, database=None):
+        """
+        Write password for a postgresql database to a .pgpass file on remote host
+        database, default the database in src. Use "*" for replication connections
+        Returns the filename, used with PGPASSFILE
+        """
+        # hostname:port:database:username:password
+        pgpass_file = remote_srv.tmpname(".pgpass", directory="/home/citobackup")
+        line = "%s:%s:%s:%s:%s" % (
+            src["host"],
+            "*",
+            database or src["database"],
+            src["username"],
+            src["password"],
+        )
+        remote_srv.write_to_file(filename=pgpass_file, data=line, mode="600")
+        return pgpass_file
+
+    def backup_psql_parallel(self, remote_srv, src, results=None, name=None, subname=None):
+        """
+        Backup a postgresql database, with pg_dump directory format and parallel jobs
+
+        pg_dump writes one file per table to a spool directory on the remote host,
+        the directory is backed up as files and then removed. The dump is not
+        compressed, and unchanged tables gives identical files, which dedup well.
+        """
+        database = src["database"]
+        parallel = int(src.get("parallel", 1))
+        spool = src.get("spool", "/var/tmp/citobackup/psql-%s" % database)
+        self.print_subheader("Backup postgresql database %s, %d parallel jobs" % (database, parallel))
+
+        pgpass_file = self.write_pgpass(remote_srv, src)
+
+        q = shlex.quote
+        cmd = "#!/bin/bash\n"
+        cmd += "SPOOL=%s\n" % q(spool)
+        cmd += 'rm -rf "$SPOOL" && mkdir -p -m 700 "$(dirname "$SPOOL")" || exit 1\n'
+        cmd += "PGPASSFILE=%s pg_dump -h %s -U %s -Fd -j %d -Z 0 -f \"$SPOOL\" %s || exit 1\n" % (
+            q(pgpass_file), q(src["host"]), q(src["username"]), parallel, q(database))
+        cmd += "echo dump_ok\n"
+
+        cmdfile = remote_srv.tmpname("psql_backup.sh")
+        remote_srv.write_to_file(filename=cmdfile, data=cmd, mode="700")
+        start = time.monotonic()
+        txt = remote_srv.ssh(cmdfile)
+        dump_time = time.monotonic() - start
+        print(txt)
+
+        if "dump_ok" in txt:
+            self.backup_files(remote_srv, [spool], results=results, name=name, subname=subname,
+                              tags=[database], backup_type="psql")
+        else:
+            result = citobackup_util.Backup_Result()
+            result.name = name
+            result.subname = subname
+            result.backup_type = "psql"
+            result.add_error("Dump of database %s failed" % database)
+            results.add(result)
+        if results.results:
+            results.results[-1].add_phase("dump", dump_time)
+
+        # Cleanup
+        remote_srv.ssh(["rm", "-rf", spool, pgpass_file, cmdfile])
+
     def backup_psql(self, remote_srv, src, results=None, name=None, subname=None):
         """
         Backup a postgresql database
+        With skip_unchanged, the dump is skipped if the database is unchanged
+        since last backup. With incremental: wal, archived WAL segments are
+        backed up between base backups
+        """
+        if src.get("incremental", None) == "wal":
+            self.backup_psql_wal(remote_srv, src, results=results, name=name, subname=subname)
+            return
+
+        fingerprint = None
+        if src.get("skip_unchanged", False):
+            fingerprint = self.psql_fingerprint(remote_srv, src)
+            if self.database_unchanged(remote_srv, "psql", src, fingerprint, results=results, name=name, subname=subname):
+                return
+
+        count = len(results.results)
+        if int(src.get("parallel", 1)) > 1:
+            self.backup_psql_parallel(remote_srv, src, results=results, name=name, subname=subname)
+        else:
+            self.backup_psql_stream(remote_srv, src, results=results, name=name, subname=subname)
+        self.save_database_fingerprint(remote_srv, "psql", src, fingerprint, results.results[count:])
+
+    def backup_psql_base(self, remote_srv, src, results=None, name=None, subname=None):
+        """
+        Base backup of a postgresql cluster with pg_basebackup, in a spool directory
+        The spool directory is backed up as files and removed
+        Returns the WAL segment where the base backup starts, None on failure
+        """
+        database = src["database"]
+        spool = src.get("spool", "/var/tmp/citobackup/psql-base-%s" % database)
+        self.print_subheader("Base backup postgresql %s" % src["host"])
+
+        pgpass_file = self.write_pgpass(remote_srv, src, database="*")
+
+        # Tar format, tablespaces can't be written to their paths on the server
+        # Not compressed, for dedup. WAL is taken from the archive, not included
+        q = shlex.quote
+        cmd = "#!/bin/bash\n"
+        cmd += "SPOOL=%s\n" % q(spool)
+        cmd += 'rm -rf "$SPOOL" && mkdir -p -m 700 "$SPOOL" || exit 1\n'
+        cmd += "PGPASSFILE=%s pg_basebackup -h %s -U %s -D \"$SPOOL\" -Ft -X none --checkpoint=fast || exit 1\n" % (
+            q(pgpass_file), q(src["host"]), q(src["username"]))
+        cmd += 'tar -xOf "$SPOOL/base.tar" backup_label | grep "START WAL LOCATION" || exit 1\n'
+        cmd += "echo dump_ok\n"
+
+        cmdfile = remote_srv.tmpname("psql_base.sh")
+        remote_srv.write_to_file(filename=cmdfile, data=cmd, mode="700")
+        start = time.monotonic()
+        txt = remote_srv.ssh(cmdfile)
+        dump_time = time.monotonic() - start
+        print(txt)
+
+        start_segment = None
+        m = re.search(r"START WAL LOCATION: \S+ \(file ([0-9A-F]{24})\)", txt)
+        if "dump_ok" in txt and m:
+            count = len(results.results)
+            self.backup_files(remote_srv, [spool], results=results, name=name, subname=subname,
+                              tags=[database, "base"], backup_type="psql-base")
+            if len(results.results) > count:
+                result = results.results[-1]
+                if not result.errors and result.snapshot_id:
+                    start_segment = m.group(1)
+        else:
+            result = citobackup_util.Backup_Result()
+            result.name = name
+            result.subname = subname
+            result.backup_type = "psql-base"
+            result.add_error("Base backup of %s failed" % src["host"])
+            results.add(result)
+        if results.results:
+            results.results[-1].add_phase("dump", dump_time)
+
+        # Cleanup
+        remote_srv.ssh(["rm", "-rf", spool, pgpass_file, cmdfile])
+        return start_segment
+
+    def backup_wal_segments(self, remote_srv, src, state, results=None, name=None, subname=None):
+        """
+        Backup WAL segments in archive_dir, from the start of the base backup
+        in state and not yet backed up, in one snapshot. state is updated
+        Returns list of files in archive_dir, None on failure
+        """
+        database = src["database"]
+        archive_dir = src["archive_dir"].rstrip("/")
+        self.print_subheader("Backup WAL segments in %s" % archive_dir)
+        files = sorted(remote_srv.ssh(["ls", "-1", archive_dir]).split())
+        segments = []
+        history = []
+        for filename in files:
+            if re.match(r"^[0-9A-F]{24}(\.[0-9A-F]{8}\.backup)?$", filename):
+                if filename[:24] < state["start_segment"]:
+                    continue
+                if state["last_segment"] and filename <= state["last_segment"]:
+                    continue
+                segments.append(filename)
+            elif re.match(r"^[0-9A-F]{8}\.history$", filename) and filename not in state["history"]:
+                history.append(filename)
+
+        if not segments and not history:
+            print("No new WAL segments")
+            return files
+
+        count = len(results.results)
+        tags = [database, "wal", "base:%s" % state["base_snapshot"]]
+        self.backup_files(remote_srv, ["%s/%s" % (archive_dir, f) for f in history + segments],
+                          results=results, name=name, subname=subname, tags=tags, backup_type="wal")
+        if len(results.results) == count:
+            return None
+        result = results.results[-1]
+        if result.errors or not result.snapshot_id:
+            return None
+        if segments:
+            state["last_segment"] = segments[-1]
+        state["history"] += history
+        state["increments"].append({
+            "snapshot": result.snapshot_id,
+            "first_segment": segments[0] if segments else None,
+            "last_segment": segments[-1] if segments else None,
+            "time": time.time(),
+        })
+        return files
+
+    def backup_psql_wal(self, remote_srv, src, results=None, name=None, subname=None):
+        """
+        Backup a postgresql cluster, base backup and archived WAL segments
+
+        A base backup is done every full_every_days days. On each run, the WAL
+        segments in archive_dir not yet backed up are backed up as files, in one
+        snapshot. Gives point in time recovery, from the base backup and the
+        WAL segments. archive_command on the server must copy segments to
+        archive_dir, and the user needs the REPLICATION privilege.
+
+        With prune_archive, segments older than the start of the latest base
+        backup are removed from archive_dir, after they are backed up
+        """
+        database = src["database"]
+        full_every_days = float(src.get("full_every_days", 7))
+        cache_file = citobackup_util.cache_file("wal", "%s.json" % remote_srv.hostname)
+        with self.lock:
+            state = citobackup_util.load_json(cache_file, default={}).get(database, None)
+
+        def save():
+            with self.lock:
+                all_state = citobackup_util.load_json(cache_file, default={})
+                all_state[database] = state
+                citobackup_util.save_json(cache_file, all_state)
+
+        files = None
+        if state is not None:
+            # Segments for the current base backup, before a new base backup is done
+            files = self.backup_wal_segments(remote_srv, src, state, results=results, name=name, subname=subname)
+            if files is None:
+                return
+            save()
+
+        if state is None or time.time() - state["base_time"] >= full_every_days * 86400:
+            start_segment = self.backup_psql_base(remote_srv, src, results=results, name=name, subname=subname)
+            if start_segment is None:
+                return
+            state = {
+                "base_snapshot": results.results[-1].snapshot_id,
+                "base_time": time.time(),
+                "start_segment": start_segment,
+                "last_segment": None,
+                "history": [],
+                "increments": [],
+            }
+            save()
+            files = self.backup_wal_segments(remote_srv, src, state, results=results, name=name, subname=subname)
+            if files is None:
+                return
+            save()
+
+        if src.get("prune_archive", False):
+            # Only needed by older base backups, they are in the repository
+            old = [f for f in files if re.match(r"^[0-9A-F]{24}", f) and f[:24] < state["start_segment"]]
+            if old:
+                print("Removing %d WAL segments from %s" % (len(old), src["archive_dir"]))
+                remote_srv.ssh(["cd", src["archive_dir"], "&&", "rm", "-f"] + old)
+
+    def backup_psql_stream(self, remote_srv, src, results=None, name=None, subname=None):
+        """
+        Backup a postgresql database, pg_dump is piped to restic
         We don't compress the backup, compression makes dedup very hard
         """
         self.print_subheader("Backup postgresql database %s" % src["database"])
@@ -334,28 +1398,19 @@ class Restic:
         result.subname = subname
         result.backup_type = "psql"
 
-        # Write password to .pgpass
-        # hostname:port:database:username:password
-        pgpass_file = "/home/citobackup/.pgpass"
-        line = "%s:%s:%s:%s:%s" % (
-            src["host"],
-            "*",
-            src["database"],
-            src["username"],
-            src["password"],
-        )
-        remote_srv.write_to_file(filename=pgpass_file, data=line, mode="600")
+        pgpass_file = self.write_pgpass(remote_srv, src)
 
         # Write command file to remote host
-        cmdfile = "/tmp/psql_backup.sh"
+        cmdfile = remote_srv.tmpname("psql_backup.sh")
         cmd = []
+        cmd += ["PGPASSFILE=%s" % pgpass_file]
         cmd += ["pg_dump"]
         cmd += ["-h", src["host"]]
         cmd += ["-U", src["username"]]
         cmd += [src["database"]]
         cmd += ["|"]
 
-        cmd += ["/opt/restic/restic"]
+        cmd += [self.remote_restic(remote_srv)]
         cmd += ["-r", "sftp:127.0.0.1:%s/%s" % (self.config.default_dest, remote_srv.hostname), "backup"]
         cmd += ["-p", "/tmp/restic_password.txt"]
 
@@ -366,7 +1421,7 @@ class Restic:
         cmd = "#!/bin/bash\n" + " ".join(cmd)
         remote_srv.write_to_file(filename=cmdfile, data=cmd, mode="700")
        
-        output = remote_srv.ssh(cmdfile, decode_json=True)
+        output = self.run_backup(remote_srv, cmdfile, results=[result])
         self.add_backup_output(output=output, result=result)
         results.add(result)
 
@@ -383,6 +1438,7 @@ class Restic:
         result = citobackup_util.Backup_Result()
         result.name = "Wordpress site"
         result.subname = name
+        result.backup_type = "wordpress"
         result.include_stat = False
         results.add(result)
 
@@ -408,186 +1464,1214 @@ class Restic:
         # Backup the mysql database
         self.backup_mysql(remote_srv, param, results=results, name="", subname="")
 
-    def backup_host(self, hostname, backup):
+    def backup_item(self, remote_srv, backup2, results=None, name=None, subname=None):
         """
-        Copy needed files to server, and run backup
+        Backup one item in the host configuration, using the backup type
         """
-        self.print_header("Running backup on %s" % hostname)
-        backup.results = citobackup_util.Backup_Results()
+        if backup2.type == "docker-compose":
+            self.backup_docker_compose(remote_srv, backup2.src, results=results, name=name, subname=subname)
 
-        # Initialize SSH to remote server
-        port = backup.get("port", None)
-        if port:
-            port = int(port)
-        remote_srv = SSH(hostname=hostname, port=port, username="citobackup")
+        elif backup2.type == "esxi":
+            self.backup_esxi(remote_srv, backup2.src, results=results, name=name, subname=subname)
 
-        remote_srv.connect()
+        elif backup2.type == "files":
+            self.backup_files(remote_srv, backup2.src, results=results, name=name, subname=subname)
+
+        elif backup2.type == "mysql":
+            self.backup_mysql(remote_srv, backup2.src, results=results, name=name, subname=subname)
+
+        elif backup2.type == "osticket":
+            self.backup_osticket(remote_srv, backup2.src, results=results, name=name, subname=subname)
+
+        elif backup2.type == "psql":
+            self.backup_psql(remote_srv, backup2.src, results=results, name=name, subname=subname)
+
+        elif backup2.type == "wordpress":
+            self.backup_wordpress(remote_srv, backup2.src, results=results, name=name, subname=subname)
+
+        else:
+            print("Error: Unknown backup type %s" % backup2.type)
+
+    def backup_items(self, remote_srv, items, results=None, jobs=1, coalesce_files=False):
+        """
+        Backup the items on one host
+
+        With jobs > 1, items are run in parallel over the same persistent ssh
+        connection. docker-compose items are run one after another, so stop/start
+        of the applications are done in configuration order.
+        With coalesce_files, all files items are backed up in one restic run.
+
+        Each item collects its results separately, they are added to results
+        in configuration order
+        """
+        item_results = [citobackup_util.Backup_Results() for item in items]
+
+        def run_items(ixs):
+            for ix in ixs:
+                backup2, name, subname = items[ix]
+                try:
+                    self.backup_item(remote_srv, backup2, results=item_results[ix], name=name, subname=subname)
+                except:
+                    print("----- Error during backup of %s %s -----" % (name, subname))
+                    print(traceback.format_exc())
+
+        def run_files(ixs):
+            try:
+                self.backup_files_coalesced(remote_srv, [items[ix] for ix in ixs], results=[item_results[ix] for ix in ixs])
+            except:
+                print("----- Error during backup of files -----")
+                print(traceback.format_exc())
+
+        # Each task is run as a unit, ordered on its first item
+        tasks = []
+        grouped = []
+        docker_compose = [ix for ix, item in enumerate(items) if item[0].type == "docker-compose"]
+        if docker_compose and jobs > 1:
+            tasks.append([docker_compose[0], run_items, docker_compose])
+            grouped += docker_compose
+        files = [ix for ix, item in enumerate(items) if item[0].type == "files"]
+        if coalesce_files and len(files) > 1:
+            tasks.append([files[0], run_files, files])
+            grouped += files
+        for ix, item in enumerate(items):
+            if ix not in grouped:
+                tasks.append([ix, run_items, [ix]])
+        tasks.sort(key=lambda task: task[0])
+
+        if jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                for ix, func, ixs in tasks:
+                    executor.submit(func, ixs)
+        else:
+            for ix, func, ixs in tasks:
+                func(ixs)
+
+        for item_result in item_results:
+            results.extend(item_result)
+
+    def remote_ssh_config(self, tunnel_port):
+        """
+        Return content of the remote .ssh/config, with the port in the
+        template replaced by the reverse forwarded port for this host
+        """
+        with open(SSH_CONFIG_TEMPLATE, "r") as f:
+            template = f.read()
+        return re.sub(r"(?mi)^(\s*port\s+)\d+", r"\g<1>" + str(tunnel_port), template)
+
+    def remote_known_hosts(self, tunnel_port):
+        """
+        Return content of the remote .ssh/known_hosts
+        The tunnel ends in our own sshd, so the host keys are read locally
+        """
+        lines = []
+        for filename in sorted(glob.glob(SSH_HOST_KEYS)):
+            with open(filename, "r") as f:
+                keytype, key = f.readline().split()[:2]
+            lines.append("[127.0.0.1]:%s %s %s" % (tunnel_port, keytype, key))
+        return "\n".join(lines) + "\n"
+
+    def bootstrap_host(self, remote_srv, tunnel_port):
+        """
+        Setup remote host, so restic can connect back to us through the tunnel,
+        and copy the restic password file
 
-        # Create .ssh dir and set permissions
-        remote_srv.ssh(["mkdir", "/home/citobackup/.ssh"])
-        remote_srv.chmod(path="/home/citobackup/.ssh", mode="700")
+        The desired remote .ssh state is fingerprinted. One remote command copies
+        the password file and returns the remote fingerprint, public key and
+        the sha256 and version of the remote restic binary. The
+        setup steps are only done if something changed. The remote public key is
+        cached locally, our authorized_keys is only updated when it changes.
 
-        # generate keys on remote system, if there are none
-        if not remote_srv.file_exists(".ssh/id_rsa"):
-            print("Generating keys on remote system")
-            remote_srv.ssh(["ssh-keygen", "-N", "''", "-f", ".ssh/id_rsa"])
+        Returns the remote state, as a dict
+        """
+        ssh_config = self.remote_ssh_config(tunnel_port)
+        known_hosts = self.remote_known_hosts(tunnel_port)
+        fingerprint = hashlib.sha256((ssh_config + known_hosts).encode()).hexdigest()
+
+        cache_file = citobackup_util.cache_file("bootstrap", "%s.json" % remote_srv.hostname)
+        cache = citobackup_util.load_json(cache_file, default={})
+
+        with open("/etc/citobackup/restic_password.txt", "r") as f:
+            password = f.read()
+        cmd = "umask 077; cat >/tmp/restic_password.txt;"
+        cmd += " echo fingerprint=$(cat %s 2>/dev/null);" % BOOTSTRAP_FINGERPRINT
+        cmd += " echo pubkey=$(cat .ssh/id_rsa.pub 2>/dev/null);"
+        restic = self.remote_restic_path() or RESTIC_BINARY
+        cmd += " echo restic_sha256=$(sha256sum %s 2>/dev/null | cut -d' ' -f1);" % restic
+        cmd += " echo restic_version=$(%s version 2>/dev/null)" % restic
+        txt = remote_srv.ssh([cmd], input=password)
+        state = {}
+        for line in txt.split("\n"):
+            key, sep, value = line.partition("=")
+            if sep:
+                state[key] = value.strip()
+
+        remote_id_rsa_pub = state.get("pubkey", "")
+        if state.get("fingerprint", "") != fingerprint or not remote_id_rsa_pub:
+            print("Setup ssh on remote system")
+
+            # Create .ssh dir and set permissions
+            remote_srv.ssh(["mkdir", "-p", "/home/citobackup/.ssh"])
+            remote_srv.chmod(path="/home/citobackup/.ssh", mode="700")
+
+            # generate keys on remote system, if there are none
+            if not remote_id_rsa_pub:
+                print("Generating keys on remote system")
+                remote_srv.ssh(["ssh-keygen", "-N", "''", "-f", ".ssh/id_rsa"])
+                remote_id_rsa_pub = remote_srv.read_from_file(".ssh/id_rsa.pub").strip()
+
+            remote_srv.write_to_file(filename=".ssh/known_hosts", data=known_hosts, mode="600")
+            remote_srv.write_to_file(filename=".ssh/config", data=ssh_config, mode="600")
+            remote_srv.write_to_file(filename=BOOTSTRAP_FINGERPRINT, data=fingerprint, mode="600")
+
+        # Add remote pub key to our local authorized_keys
+        if cache.get("pubkey", "") != remote_id_rsa_pub:
+            remote_srv.add_authorized_keys(remote_id_rsa_pub)
+
+        citobackup_util.save_json(cache_file, {"fingerprint": fingerprint, "pubkey": remote_id_rsa_pub})
+        return state
+
+    def tunnel_ports(self):
+        """
+        Return dict hostname -> remote port used for the reverse forwarding.
+        Each host gets its own port, so hosts can be backed up in parallel
+        The port can be overridden with tunnel_port in the host configuration,
+        the other hosts get ports counting up from the base, skipping the
+        overridden ports. Raises ValueError if two hosts override the same port
+        """
+        base = int(self.config.get("tunnel_port", TUNNEL_PORT))
+        ports = {}
+        used = {}   # port -> hostname, overridden ports
+        for hostname, backup in self.backups.iter():
+            if backup.get("tunnel_port", None):
+                port = int(backup["tunnel_port"])
+                if port in used:
+                    raise ValueError("tunnel_port %d of %s is also used by %s" % (port, hostname, used[port]))
+                used[port] = hostname
+                ports[hostname] = port
+        port = base
+        for hostname, backup in self.backups.iter():
+            if hostname not in ports:
+                while port in used:
+                    port += 1
+                ports[hostname] = port
+                port += 1
+        return ports
+
+    def open_host(self, hostname, port=None, tunnel_port=TUNNEL_PORT, result=None):
+        """
+        Open ssh to remote host with reverse port forwarding back to us, and
+        setup the host for restic. Time for each phase is added to result
+        Returns the SSH
+        """
+        if port:
+            port = int(port)
+        remote_srv = SSH(hostname=hostname, port=port, username="citobackup", tunnel_port=tunnel_port)
+        if result is None:
+            result = citobackup_util.Backup_Result()
 
-        # Fetch remote pub key, and add to our local authorized_keys
-        remote_id_rsa_pub = remote_srv.read_from_file(".ssh/id_rsa.pub")
-        remote_srv.add_authorized_keys(remote_id_rsa_pub)
+        start = time.monotonic()
+        remote_srv.connect()
+        result.add_phase("connect", time.monotonic() - start)
 
-        # Generate remote known_host
-        remote_srv.ssh(["ssh-keyscan", "-p", "44444", "127.0.0.1", ">.ssh/known_hosts"])
+        start = time.monotonic()
+        state = self.bootstrap_host(remote_srv, tunnel_port)
+        self.install_restic(remote_srv, state)
+        result.add_phase("bootstrap", time.monotonic() - start)
+        return remote_srv
 
-        # copy .ssh configuration
-        remote_srv.scp(local="/opt/citobackup/remote/ssh-config", remote=".ssh/config", mode="600")
+    def close_host(self, remote_srv, result=None):
+        """
+        Remove the restic password from remote host, and close ssh
+        """
+        start = time.monotonic()
+        remote_srv.unlink(path="/tmp/restic_password.txt")
 
-        # Check if there is a remote backup binary
-        # remote_srv.scp(local="/opt/restic/restic", remote=".")
+        remote_srv.disconnect()
+        if result is not None:
+            result.add_phase("teardown", time.monotonic() - start)
 
-        # copy restic password file
-        remote_srv.scp(local="/etc/citobackup/restic_password.txt", remote="/tmp/restic_password.txt", mode="600")
+    def backup_host(self, hostname, backup, tunnel_port=TUNNEL_PORT):
+        """
+        Copy needed files to server, and run backup
+        """
+        self.print_header("Running backup on %s" % hostname)
+        backup.results = citobackup_util.Backup_Results()
 
+        # Phase timings of the host are kept in the hostname row
         result = citobackup_util.Backup_Result()
         result.hostname = hostname
         result.include_stat = False
 
         backup.results.add(result)
 
+        # Initialize SSH to remote server
+        remote_srv = self.open_host(hostname, port=backup.get("port", None), tunnel_port=tunnel_port, result=result)
+
+        # List of backup items, in configuration order
+        items = []
         for backup1 in backup["backups"]:
             name = backup1.get("name", "")
             backup_list = backup1.get("backup", [])
             for backup2 in backup_list:
-                subname = backup2.get("name", "")
-                if backup2.type == "docker-compose":
-                    self.backup_docker_compose(remote_srv, backup2.src, results=backup.results, name=name, subname=subname)
+                items.append([backup2, name, backup2.get("name", "")])
+
+        self.backup_items(remote_srv, items,
+                          results=backup.results,
+                          jobs=int(backup.get("jobs", 1)),
+                          coalesce_files=backup.get("coalesce_files", False),
+                          )
+
+        # Remove old snapshots, prune is done separately
+        if self.prune_config()["forget_after_backup"]:
+            start = time.monotonic()
+            removed = self.forget(hostname)
+            result.add_phase("forget", time.monotonic() - start)
+            if removed is None:
+                result.add_error("Forget of old snapshots failed")
+            elif removed:
+                print("Forget: removed %d old snapshots" % removed)
+
+        self.close_host(remote_srv, result=result)
+    
+    def backup_host_catch(self, hostname, backup, tunnel_port, history=None, run_id=None, path_index=None):
+        """
+        Backup one host, an error is printed and does not affect other hosts
+        The results are saved in the history database, also on errors
+        New snapshots are added to the path index
+        """
+        start = time.monotonic()
+        try:
+            self.backup_host(hostname, backup, tunnel_port=tunnel_port)
+        except:
+            print("----- Error during backup of %s -----" % hostname)
+            print(traceback.format_exc())
+            results = getattr(backup, "results", None)
+            if results and results.results:
+                results.results[0].add_error("Backup of %s failed" % hostname)
+        results = getattr(backup, "results", None)
+        if results and results.results:
+            # Duration of the host backup, in the hostname row
+            results.results[0].total_duration = time.monotonic() - start
+        if history and getattr(backup, "results", None):
+            try:
+                history.add_results(run_id, hostname, backup.results)
+            except:
+                print("----- Error saving history of %s -----" % hostname)
+                print(traceback.format_exc())
+        if path_index:
+            try:
+                self.index_host(path_index, hostname)
+            except:
+                print("----- Error during indexing of %s -----" % hostname)
+                print(traceback.format_exc())
 
-                elif backup2.type == "files":
-                    self.backup_files(remote_srv, backup2.src, results=backup.results, name=name, subname=subname)
+    def backup(self, hostname_filter=None, port=None, jobs=1):
+        """
+        Backup hosts
+        Up to jobs hosts are backed up at the same time
+        Each result is saved in the history database, and new snapshots are
+        added to the path index, unless index.after_backup is false
+        """
+        tunnel_ports = self.tunnel_ports()
+        history = History()
+        run_id = history.start_run("backup")
+        path_index = None
+        index_config = self.config.get("index", None) or {}
+        if index_config.get("after_backup", True):
+            path_index = Path_Index()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for hostname, backup in self.backups.iter(hostname_filter):
+                executor.submit(self.backup_host_catch, hostname, backup, tunnel_ports[hostname],
+                                history=history, run_id=run_id, path_index=path_index)
+        history.finish_run(run_id)
+        metrics_config = self.config.get("metrics", None) or {}
+        if metrics_config.get("textfile", None):
+            try:
+                citobackup_metrics.write_textfile(metrics_config["textfile"], self.metrics(history=history))
+            except:
+                print("----- Error writing metrics to %s -----" % metrics_config["textfile"])
+                print(traceback.format_exc())
+        history.close()
+        if path_index:
+            path_index.close()
 
-                elif backup2.type == "mysql":
-                    self.backup_mysql(remote_srv, backup2.src, results=backup.results, name=name, subname=subname)
+        return self.backups
 
-                elif backup2.type == "osticket":
-                    self.backup_osticket(remote_srv, backup2.src, results=backup.results, name=name, subname=subname)
+    def metrics(self, history=None):
+        """
+        Return metrics of the last backup of each configured host, in
+        OpenMetrics text format
+        """
+        close = history is None
+        if history is None:
+            history = History()
+        hostnames = [hostname for hostname, backup in self.backups.iter()]
+        results = history.latest_results(hostnames)
+        phases = history.phases([row["id"] for row in results])
+        if close:
+            history.close()
+        return str(citobackup_metrics.backup_metrics(results, phases))
+
+    def history(self, hostname_filter=None, days=30):
+        """
+        Return a Table with backup history of the last days, slowest items first
+        """
+        history = History()
+        rows = history.report(days=days, hostname=hostname_filter)
+        history.close()
+
+        t = citobackup_util.Table(headers=[
+            "hostname", "name", "type", "subname", "runs",
+            "duration<br>avg", "duration<br>max", "data<br>added", "errors", "last success",
+        ])
+        for row in rows:
+            t.add_cell(row["hostname"])
+            t.add_cell(row["name"])
+            t.add_cell(row["backup_type"])
+            t.add_cell(row["subname"])
+            t.add_cell(row["runs"])
+            t.add_cell(round(row["avg_duration"] or 0, 1))
+            t.add_cell(round(row["max_duration"] or 0, 1))
+            t.add_cell(citobackup_util.human_readable_size(row["data_added"] or 0))
+            t.add_cell(row["errors"])
+            if row["last_success"]:
+                t.add_cell(time.strftime("%Y-%m-%d %H:%M", time.localtime(row["last_success"])))
+            else:
+                t.add_cell("never")
+            t.add_row()
+        return t
+
+    def check_repo(self, hostname, subsets):
+        """
+        Check one repository, and read the next subset of the pack data
+        The subset to read is rotated, with the state kept locally
+        Returns [hostname, subset, duration, returncode, output]
+        """
+        state_file = citobackup_util.cache_file("check", "%s.json" % hostname)
+        state = citobackup_util.load_json(state_file, default={})
+        n = state.get("next", 1)
+        if state.get("subsets", subsets) != subsets or n > subsets:
+            n = 1   # Number of subsets changed, restart the rotation
+        subset = "%d/%d" % (n, subsets)
+
+        cmd = [self.local_restic()]
+        cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
+        cmd += ["-p", "/etc/citobackup/restic_password.txt"]
+        cmd += ["check", "--no-lock", "--json"]
+        if subsets > 0:
+            cmd += ["--read-data-subset=%s" % subset]
+        start = time.monotonic()
+        r, txt = citobackup_util.run_cmd(cmd)
+        duration = time.monotonic() - start
+
+        if subsets > 0:
+            # A failed subset is read again on the next check
+            state["subsets"] = subsets
+            if r.returncode == 0:
+                state["next"] = n % subsets + 1
+                if n == subsets:
+                    state["completed"] = time.time()     # All data has been read
+            else:
+                state["next"] = n
+            state["last"] = {"subset": subset, "time": time.time(), "returncode": r.returncode}
+            citobackup_util.save_json(state_file, state)
+        return [hostname, subset if subsets > 0 else "", duration, r.returncode, txt]
+
+    def check(self, hostname_filter=None, jobs=None):
+        """
+        Check repositories, up to jobs in parallel
 
-                elif backup2.type == "psql":
-                    self.backup_psql(remote_srv, backup2.src, results=backup.results, name=name, subname=subname)
+        Each check reads the next of check.subsets subsets of the pack data, with
+        --read-data-subset. With one check each day and 30 subsets, all data is
+        read once every 30 days. check.subsets 0 checks only the metadata.
+        Checks are limited by the disk I/O on the backup server, check.jobs sets
+        how many runs in parallel.
+        """
+        check_config = self.config.get("check", None) or {}
+        subsets = int(check_config.get("subsets", 30))
+        if jobs is None:
+            jobs = int(check_config.get("jobs", 2))
+
+        hostnames = [hostname for hostname, backup in self.backups.iter(hostname_filter)]
+        t = citobackup_util.Table(headers=["hostname", "subset", "duration", "result"])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [executor.submit(self.check_repo, hostname, subsets) for hostname in hostnames]
+            for hostname, future in zip(hostnames, futures):
+                try:
+                    hostname, subset, duration, returncode, txt = future.result()
+                except:
+                    print("----- Error during check of %s -----" % hostname)
+                    print(traceback.format_exc())
+                    t.add_cell(hostname)
+                    t.add_cell("")
+                    t.add_cell("")
+                    t.add_cell("failed")
+                    t.add_row()
+                    continue
+                self.print_header("Check repo %s %s" % (hostname, subset))
+                print(txt)
+                t.add_cell(hostname)
+                t.add_cell(subset)
+                t.add_cell(round(duration, 1))
+                t.add_cell("ok" if returncode == 0 else "errors, exit code %d" % returncode)
+                t.add_row()
+        print(t)
 
-                elif backup2.type == "wordpress":
-                    self.backup_wordpress(remote_srv, backup2.src, results=backup.results, name=name, subname=subname)
+    def init(self, hostname=None):
+        """
+        """
+        cmd = [self.local_restic()]
+        cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
+        cmd += ["init"]
+        cmd += ["-p", "/etc/citobackup/restic_password.txt"]
+        r, txt = citobackup_util.run_cmd(cmd)
+        print(txt)
 
-                else:
-                    print("Error: Unknown backup type %s" % backup2.type)
+    def ls_filter(self, path=None, min_size=None, max_size=None, newer=None, older=None):
+        """
+        Return function node -> True if the node from restic ls --json matches
+        path is a path prefix, or a glob pattern if it contains *?[
+        """
+        if path and any(c in path for c in "*?["):
+            match_path = lambda p: fnmatch.fnmatchcase(p, path)
+        elif path:
+            prefix = path.rstrip("/")
+            match_path = lambda p: p == prefix or p.startswith(prefix + "/")
+        else:
+            match_path = None
+
+        def match(node):
+            if match_path and not match_path(node.get("path", "")):
+                return False
+            size = node.get("size", 0)
+            if min_size is not None and size < min_size:
+                return False
+            if max_size is not None and size > max_size:
+                return False
+            if newer is not None or older is not None:
+                mtime = citobackup_util.parse_time(node.get("mtime", ""))
+                if mtime is None:
+                    return False
+                if newer is not None and mtime < newer:
+                    return False
+                if older is not None and mtime > older:
+                    return False
+            return True
+        return match
+
+    def format_node(self, node):
+        """
+        Return one line for a node from restic ls --json, as restic ls -l
+        """
+        permissions = node.get("permissions", None)
+        if not permissions:
+            mode = node.get("mode", 0)
+            permissions = {"dir": "d", "symlink": "l"}.get(node.get("type", ""), "-")
+            for shift in [6, 3, 0]:
+                bits = (mode >> shift) & 7
+                permissions += "r" if bits & 4 else "-"
+                permissions += "w" if bits & 2 else "-"
+                permissions += "x" if bits & 1 else "-"
+        mtime = node.get("mtime", "")[:19].replace("T", " ")
+        return "%s %5s %5s %12s %s %s" % (
+            permissions, node.get("uid", ""), node.get("gid", ""), node.get("size", 0), mtime, node.get("path", ""))
+
+    def ls(self, hostname=None, id=None, refresh=False, path=None, limit=None,
+           min_size=None, max_size=None, newer=None, older=None):
+        """
+        List files in a snapshot
 
-        remote_srv.unlink(path="/tmp/restic_password.txt")
+        The output of restic ls --json is read and printed one line at a time,
+        memory use does not depend on the size of the snapshot. The listing is
+        cached while it is read, a snapshot never changes.
 
-        remote_srv.disconnect()
-    
-    def backup(self, hostname_filter=None, port=None):
+        Filters: path prefix or glob, size in bytes, and mtime in seconds since
+        epoch. limit stops after that many matching files.
         """
-        Backup hosts
+        repo = "%s/%s" % (self.config.default_dest, hostname)
+        cache = Repo_Cache(repo, hostname)
+        snapshot = self.find_snapshot(self.cached_snapshots(hostname, refresh=refresh), id)
+        lines = None
+        stream = None
+        if snapshot and not refresh:
+            lines = cache.load_ls(snapshot["id"])
+        if lines is None:
+            cmd = [self.local_restic()]
+            cmd += ["-r", repo]
+            cmd += ["-p", "/etc/citobackup/restic_password.txt"]
+            cmd += ["--no-lock"]
+            cmd += ["ls", "--json", snapshot["id"] if snapshot else id]
+            stream = citobackup_util.Stream_Cmd(cmd)
+            lines = stream
+            if snapshot:
+                lines = cache.save_ls(snapshot["id"], stream, complete=lambda: stream.returncode == 0)
+
+        match = self.ls_filter(path=path, min_size=min_size, max_size=max_size, newer=newer, older=older)
+        count = 0
+        try:
+            for line in lines:
+                try:
+                    node = json.loads(line)
+                except ValueError:
+                    continue
+                if node.get("struct_type", "node") != "node":
+                    print("snapshot %s of %s at %s:" % (
+                        node.get("short_id", ""), node.get("paths", []), node.get("time", "")[:19].replace("T", " ")))
+                    continue
+                if not match(node):
+                    continue
+                print(self.format_node(node))
+                count += 1
+                if limit and count >= limit:
+                    break
+        finally:
+            if hasattr(lines, "close"):
+                lines.close()
+        if stream and stream.returncode:
+            print("Error: restic ls exit code %d" % stream.returncode)
+
+    def ls_nodes(self, hostname, snapshot_id):
         """
-        for hostname, backup in self.backups.iter(hostname_filter):
+        Yield the nodes in a snapshot, as from restic ls --json
+        The cached listing is used if there is one
+        """
+        repo = "%s/%s" % (self.config.default_dest, hostname)
+        lines = Repo_Cache(repo, hostname).load_ls(snapshot_id)
+        stream = None
+        if lines is None:
+            cmd = [self.local_restic()]
+            cmd += ["-r", repo]
+            cmd += ["-p", "/etc/citobackup/restic_password.txt"]
+            cmd += ["--no-lock"]
+            cmd += ["ls", "--json", snapshot_id]
+            stream = citobackup_util.Stream_Cmd(cmd)
+            lines = iter(stream)
+        try:
+            for line in lines:
+                try:
+                    node = json.loads(line)
+                except ValueError:
+                    continue
+                if node.get("struct_type", "node") == "node":
+                    yield node
+        finally:
+            lines.close()
+        if stream and stream.returncode:
+            raise RuntimeError("restic ls %s exit code %d" % (snapshot_id, stream.returncode))
+
+    def index_host(self, path_index, hostname, refresh=False):
+        """
+        Add new snapshots of a host to the path index, oldest first
+        Snapshots removed from the repository are removed from the index
+        """
+        snapshots = self.cached_snapshots(hostname, refresh=refresh)
+        if snapshots is None:
+            return
+        indexed = path_index.indexed(hostname)
+        snapshot_ids = set(snapshot["id"] for snapshot in snapshots)
+        removed = indexed - snapshot_ids
+        if removed:
+            print("Index %s: removing %d snapshots" % (hostname, len(removed)))
+            path_index.remove_snapshots(hostname, removed)
+        for snapshot in sorted(snapshots, key=lambda snapshot: snapshot["time"]):
+            if snapshot["id"] in indexed:
+                continue
+            start = time.monotonic()
+            count = path_index.add_snapshot(hostname, snapshot, self.ls_nodes(hostname, snapshot["id"]))
+            print("Index %s: snapshot %s, %d files, %.1f seconds" % (
+                hostname, snapshot["id"][:8], count, time.monotonic() - start))
+
+    def index(self, hostname_filter=None, refresh=False, jobs=None):
+        """
+        Update the path index with new snapshots in all repositories
+        Up to jobs repositories are listed in parallel, default index.jobs
+        """
+        if jobs is None:
+            jobs = int((self.config.get("index", None) or {}).get("jobs", 2))
+        path_index = Path_Index()
+        hostnames = [hostname for hostname, backup in self.backups.iter(hostname_filter)]
+
+        def index_host(hostname):
             try:
-                self.backup_host(hostname, backup)
+                self.index_host(path_index, hostname, refresh=refresh)
             except:
-                print("----- Error during backup -----")
+                print("----- Error during indexing of %s -----" % hostname)
                 print(traceback.format_exc())
 
-        return self.backups
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(index_host, hostnames))
+        path_index.close()
 
-    def check(self, hostname_filter=None):
+    def find(self, pattern, hostname_filter=None, limit=None):
         """
+        Find files in all snapshots, using the path index
+        pattern is a glob pattern if it contains *?[, otherwise a substring
+        Returns a Table
         """
-        for hostname, backup in self.backups.iter(hostname_filter):
-            self.print_header("Check repo %s" % hostname)
-            cmd = ["/opt/restic/restic"]
-            cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
+        path_index = Path_Index()
+        rows = path_index.find(pattern, hostname=hostname_filter, limit=limit or 1000)
+        path_index.close()
+
+        t = citobackup_util.Table(headers=["hostname", "path", "size", "mtime", "first seen", "last seen", "snapshot ID"])
+        for row in rows:
+            t.add_cell(row["hostname"])
+            t.add_cell(row["path"] + ("/" if row["type"] == "dir" else ""))
+            t.add_cell(row["size"])
+            t.add_cell(row["mtime"][:19].replace("T", " "))
+            t.add_cell(time.strftime("%Y-%m-%d %H:%M", time.localtime(row["first_seen"])))
+            t.add_cell(time.strftime("%Y-%m-%d %H:%M", time.localtime(row["last_seen"])))
+            t.add_cell((row["snapshot_id"] or "removed")[:8])
+            t.add_row()
+        return t
+
+    def cached_snapshots(self, hostname, refresh=False):
+        """
+        Return list of snapshots in a repository, as from restic snapshots --json
+        restic is only run if the repository has changed since last call
+        Returns None on error
+        """
+        repo = "%s/%s" % (self.config.default_dest, hostname)
+        cache = Repo_Cache(repo, hostname)
+        snapshots = None
+        if not refresh:
+            snapshots = cache.load("snapshots")
+        if snapshots is None:
+            cmd = [self.local_restic()]
+            cmd += ["-r", repo]
             cmd += ["-p", "/etc/citobackup/restic_password.txt"]
-            cmd += ["check", "--no-lock", "--json"]
+            cmd += ["--no-lock"]
+            cmd += ["snapshots", "--json"]
             r, txt = citobackup_util.run_cmd(cmd)
+            try:
+                snapshots = json.loads(r.stdout)
+            except json.decoder.JSONDecodeError:
+                print("Error: can't list snapshots for %s" % hostname)
+                print(txt)
+                return None
+            cache.save("snapshots", snapshots)
+            cache.expire_ls(set(snapshot["id"] for snapshot in snapshots))
+        return snapshots
+
+    def find_snapshot(self, snapshots, id):
+        """
+        Return the snapshot matching id, a snapshot id, short id or "latest"
+        None if not found
+        """
+        if not snapshots:
+            return None
+        if id == "latest":
+            return max(snapshots, key=lambda snapshot: snapshot["time"])
+        matches = [snapshot for snapshot in snapshots if snapshot["id"].startswith(id)]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def prune_config(self):
+        """
+        Return prune settings, with defaults
+        """
+        prune_config = self.config.get("prune", None) or {}
+        return {
+            "keep_daily": int(prune_config.get("keep_daily", 365)),
+            "forget_after_backup": prune_config.get("forget_after_backup", True),
+            "threshold": float(prune_config.get("threshold", 10)),
+            "max_unused": str(prune_config.get("max_unused", "5%")),
+            "max_repack_size": prune_config.get("max_repack_size", None),
+            "budget": prune_config.get("budget", None),
+            "jobs": int(prune_config.get("jobs", 2)),
+        }
+
+    def forget(self, hostname, days=None):
+        """
+        Remove old snapshots from the repository, without pruning data
+        This is cheap, only snapshot files are removed
+        Returns number of removed snapshots, None on error
+        """
+        if days is None:
+            days = self.prune_config()["keep_daily"]
+        cmd = [self.local_restic()]
+        cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
+        cmd += ["-p", "/etc/citobackup/restic_password.txt"]
+        cmd += ["forget", "--keep-daily", str(days), "--json"]
+        r, txt = citobackup_util.run_cmd(cmd)
+        try:
+            groups = json.loads(r.stdout.split("\n")[0])
+        except json.decoder.JSONDecodeError:
+            print("Error: forget failed for %s" % hostname)
             print(txt)
+            return None
+        removed = 0
+        for group in groups or []:
+            removed += len(group.get("remove", None) or [])
+        return removed
 
-    def init(self, hostname=None):
+    def prune_stats(self, txt):
+        """
+        Parse restic prune output
+        Returns dict with unused, total, pruned and remaining bytes, unused percent
         """
+        stats = {}
+        for line in txt.split("\n"):
+            m = re.match(r"^\s*(unused|total|total prune|remaining):\s+\d+ blobs / (.+)$", line)
+            if m:
+                stats[m.group(1).replace(" ", "_")] = citobackup_util.parse_size(m.group(2)) or 0
+        if "unused" not in stats and "total_prune" in stats and "remaining" in stats:
+            # Without --verbose, the dry run with --max-unused 0 removes all unused data
+            stats["unused"] = stats["total_prune"]
+            stats["total"] = stats["total_prune"] + stats["remaining"]
+        stats["unused_percent"] = 0
+        if stats.get("total", 0):
+            stats["unused_percent"] = 100 * stats.get("unused", 0) / stats["total"]
+        return stats
+
+    def prune_check(self, hostname, days):
         """
-        cmd = ["/opt/restic/restic"]
+        Forget old snapshots, and find unused space with a prune dry run
+        Returns dict with the prune stats, or None on error
+        """
+        removed = self.forget(hostname, days)
+        cmd = [self.local_restic()]
         cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
-        cmd += ["init"]
         cmd += ["-p", "/etc/citobackup/restic_password.txt"]
+        cmd += ["prune", "--dry-run", "--verbose", "--max-unused", "0"]
         r, txt = citobackup_util.run_cmd(cmd)
-        print(txt)
+        if r.returncode != 0:
+            print("Error: prune dry run failed for %s" % hostname)
+            print(txt)
+            return None
+        stats = self.prune_stats(txt)
+        stats["removed"] = removed
+        return stats
 
-    def ls(self, hostname=None, id=None):
+    def prune_repo(self, hostname, max_unused, max_repack_size):
         """
+        Prune one repository
+        Returns [duration, reclaimed bytes, output]
         """
-        cmd = ["/opt/restic/restic"]
+        cmd = [self.local_restic()]
         cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
         cmd += ["-p", "/etc/citobackup/restic_password.txt"]
-        cmd += ["ls", "-l", id]
+        cmd += ["prune", "--max-unused", max_unused]
+        if max_repack_size is not None:
+            cmd += ["--max-repack-size", str(max_repack_size)]
+        start = time.monotonic()
         r, txt = citobackup_util.run_cmd(cmd)
-        print(txt)
+        duration = time.monotonic() - start
+        if r.returncode != 0:
+            return [duration, None, txt]
+        return [duration, self.prune_stats(txt).get("total_prune", 0), txt]
 
-    def prune(self, hostname_filter=None, days=365):
+    def prune(self, hostname_filter=None, days=None, jobs=None):
         """
+        Forget old snapshots, and prune repositories with much unused space
+
+        Old snapshots are forgotten in all repositories, and a prune dry run finds
+        the unused space. Only repositories with unused space above
+        prune.threshold percent are pruned, most unused first. Prune is heavy on
+        disk I/O, up to prune.jobs repositories are pruned in parallel. The
+        repack size of each prune is limited by prune.max_repack_size, and the
+        sum for all repositories by prune.budget.
         """
-        for hostname, backup in self.backups.iter(hostname_filter):
-            self.print_header("Pruning repo %s" % hostname)
-            cmd = ["/opt/restic/restic"]
-            cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
-            cmd += ["-p", "/etc/citobackup/restic_password.txt"]
-            cmd += ["forget", "--prune", "--keep-daily", str(days), "--json"]
-            print(cmd)
-            r, txt = citobackup_util.run_cmd(cmd)
-            # print("r", r)
-            # print(txt)
-
+        prune_config = self.prune_config()
+        if days is None:
+            days = prune_config["keep_daily"]
+        if jobs is None:
+            jobs = prune_config["jobs"]
+        max_repack_size = prune_config["max_repack_size"]
+        budget = prune_config["budget"]
+        if budget is not None:
+            budget = citobackup_util.parse_size(budget)
+
+        hostnames = [hostname for hostname, backup in self.backups.iter(hostname_filter)]
+
+        def prune_check(hostname):
+            # An error is printed, the host is skipped and does not affect other hosts
             try:
-                tmp = txt.split("\n")
-                ret = json.loads(tmp[0])
-            except json.decoder.JSONDecodeError as err:
-                print("Error:", err)
+                return self.prune_check(hostname, days)
+            except:
+                print("----- Error during prune check of %s -----" % hostname)
+                print(traceback.format_exc())
+                return None
+
+        self.print_header("Forget snapshots older than %d days, find unused space" % days)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            all_stats = dict(zip(hostnames, executor.map(prune_check, hostnames)))
+
+        # Most unused first, reserve repack size from the budget
+        candidates = [hostname for hostname in hostnames
+                      if all_stats[hostname] and all_stats[hostname]["unused_percent"] >= prune_config["threshold"]]
+        candidates.sort(key=lambda hostname: -all_stats[hostname]["unused_percent"])
+        repack_size = {}
+        for hostname in candidates:
+            size = citobackup_util.parse_size(max_repack_size) if max_repack_size is not None else None
+            if budget is not None:
+                if budget <= 0:
+                    break
+                size = budget if size is None else min(size, budget)
+                budget -= size
+            repack_size[hostname] = size
+
+        self.print_header("Prune %d of %d repositories" % (len(repack_size), len(hostnames)))
+        pruned = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = {hostname: executor.submit(self.prune_repo, hostname, prune_config["max_unused"], size)
+                       for hostname, size in repack_size.items()}
+            for hostname in candidates:
+                if hostname in futures:
+                    try:
+                        pruned[hostname] = futures[hostname].result()
+                    except:
+                        print("----- Error during prune of %s -----" % hostname)
+                        print(traceback.format_exc())
+                        pruned[hostname] = [0, None, ""]
+                        continue
+                    print("Prune %s" % hostname)
+                    print(pruned[hostname][2])
+
+        t = citobackup_util.Table(headers=["hostname", "snapshots<br>removed", "unused", "unused<br>%",
+                                           "pruned", "reclaimed", "duration"])
+        for hostname in hostnames:
+            stats = all_stats[hostname]
+            t.add_cell(hostname)
+            if stats is None:
+                t.add_cell("error")
+                for i in range(5):
+                    t.add_cell("")
+                t.add_row()
+                continue
+            t.add_cell(stats["removed"] if stats["removed"] is not None else "error")
+            t.add_cell(citobackup_util.human_readable_size(stats.get("unused", 0)))
+            t.add_cell(round(stats["unused_percent"], 1))
+            if hostname in pruned:
+                duration, reclaimed, txt = pruned[hostname]
+                t.add_cell("yes" if reclaimed is not None else "error")
+                t.add_cell(citobackup_util.human_readable_size(reclaimed or 0))
+                t.add_cell(round(duration, 1))
+            else:
+                t.add_cell("no, budget used" if hostname in candidates else "no")
+                t.add_cell("")
+                t.add_cell("")
+            t.add_row()
+        print(t)
+
+    def restore_snapshot(self, remote_srv, repo_hostname, snapshot, target, include=None, exclude=None):
+        """
+        Restore one snapshot on the remote host, restic reads the repository
+        through the tunnel. Returns a Backup_Result
+        """
+        result = citobackup_util.Backup_Result()
+        result.name = snapshot["id"][:8]
+        result.subname = ",".join(snapshot.get("paths", None) or [])
+        result.backup_type = "restore"
 
-            print("Keep count:", len(ret[0]["keep"]))
-            print("Paths:", ret[0]["paths"])
-            print("Removed:", ret[0]["remove"])
-            for s in tmp[1:]:
-                print(s)
+        cmd = []
+        cmd += [self.remote_restic(remote_srv)]
+        cmd += ["-r", "sftp:127.0.0.1:%s/%s" % (self.config.default_dest, repo_hostname)]
+        cmd += ["restore", snapshot["id"]]
+        cmd += ["-p", "/tmp/restic_password.txt"]
+        cmd += ["--target", shlex.quote(target)]
+        for pattern in include or []:
+            cmd += ["--include", shlex.quote(pattern)]
+        for pattern in exclude or []:
+            cmd += ["--exclude", shlex.quote(pattern)]
+        cmd += ["--json"]
+        print(" ".join(cmd))
+        output = self.run_backup(remote_srv, cmd, results=[result])
 
-    def snapshots(self, hostname_filter=None):
+        for r in output:
+            if r.message_type == "error":
+                result.add_error(r.msg)
+                print(r.msg)
+            elif r.message_type == "summary":
+                result.total_files_processed = r.get("files_restored", r.get("total_files", 0))
+                result.total_bytes_processed = r.get("bytes_restored", r.get("total_bytes", 0))
+                result.total_duration = r.get("seconds_elapsed", 0)
+                result.snapshot_id = snapshot["id"][:8]
+        if not result.snapshot_id:
+            result.add_error("restore did not finish")
+        return result
+
+    def restore(self, hostname=None, ids=None, target=None, target_host=None,
+                include=None, exclude=None, jobs=1):
+        """
+        Restore snapshots from the repository of hostname, directly on the
+        target host (default hostname)
+
+        restic runs on the target host and reads the repository through the
+        reverse port forwarding, the data is only moved once. With several
+        snapshots, each is restored to target/<short id> so overlapping paths
+        don't overwrite each other, up to jobs in parallel over the same ssh
+        connection. Returns (Table with the result, number of errors), None
+        if a snapshot is not found
+        """
+        if target_host is None:
+            target_host = hostname
+        snapshots = self.cached_snapshots(hostname)
+        restore_snapshots = []
+        for id in ids:
+            snapshot = self.find_snapshot(snapshots, id)
+            if snapshot is None:
+                print("Error: can't find snapshot %s for %s" % (id, hostname))
+                return None
+            restore_snapshots.append(snapshot)
+
+        backup = None
+        for tmp_hostname, tmp_backup in self.backups.iter(target_host):
+            backup = tmp_backup
+        port = backup.get("port", None) if backup else None
+        tunnel_port = self.tunnel_ports().get(target_host, TUNNEL_PORT)
+
+        self.print_header("Restore on %s to %s" % (target_host, target))
+        host_result = citobackup_util.Backup_Result()
+        remote_srv = self.open_host(target_host, port=port, tunnel_port=tunnel_port, result=host_result)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+                results = list(executor.map(
+                    lambda snapshot: self.restore_snapshot(
+                        remote_srv, hostname, snapshot,
+                        target if len(restore_snapshots) == 1 else "%s/%s" % (target.rstrip("/"), snapshot["id"][:8]),
+                        include=include, exclude=exclude),
+                    restore_snapshots))
+        finally:
+            self.close_host(remote_srv, result=host_result)
+
+        t = citobackup_util.Table(headers=["snapshot ID", "paths", "files", "bytes", "duration",
+                                           "MB/s<br>avg", "MB/s<br>peak", "errors"])
+        for result in results:
+            t.add_cell(result.name)
+            t.add_cell(result.subname)
+            t.add_cell(result.total_files_processed)
+            t.add_cell(citobackup_util.human_readable_size(result.total_bytes_processed))
+            t.add_cell(round(result.total_duration, 1))
+            t.add_cell(round(result.mbps_avg, 1))
+            t.add_cell(round(result.mbps_peak, 1))
+            t.add_cell(len(result.errors))
+            t.add_row()
+        return t, sum(len(result.errors) for result in results) + len(host_result.errors)
+
+    def snapshots(self, hostname_filter=None, refresh=False, jobs=None):
         """
         Show all snapshots
+        Repositories not changed since last call are answered from the cache,
+        changed repositories are listed with up to jobs restic in parallel,
+        default snapshots.jobs
         """
-        for hostname, backup in self.backups.iter(hostname_filter):
+        if jobs is None:
+            jobs = int((self.config.get("snapshots", None) or {}).get("jobs", 4))
+        hostnames = [hostname for hostname, backup in self.backups.iter(hostname_filter)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            all_snapshots = list(executor.map(lambda hostname: self.cached_snapshots(hostname, refresh=refresh), hostnames))
+
+        for hostname, snapshots in zip(hostnames, all_snapshots):
             self.print_header("Snapshot for %s" % hostname)
-            cmd = ["/opt/restic/restic"]
-            cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
-            cmd += ["snapshots"]
-            cmd += ["-p", "/etc/citobackup/restic_password.txt"]
-            r, txt = citobackup_util.run_cmd(cmd)
-            print(txt)
+            if snapshots is None:
+                continue
+            t = citobackup_util.Table(headers=["ID", "Time", "Host", "Tags", "Paths"])
+            for snapshot in sorted(snapshots, key=lambda snapshot: snapshot["time"]):
+                t.add_cell(snapshot.get("short_id", snapshot["id"][:8]))
+                t.add_cell(snapshot["time"][:19].replace("T", " "))
+                t.add_cell(snapshot.get("hostname", ""))
+                t.add_cell(",".join(snapshot.get("tags", None) or []))
+                t.add_cell(",".join(snapshot.get("paths", None) or []))
+                t.add_row()
+            print(t)
+            print("%d snapshots" % len(snapshots))
             print()
 
-    def stats(self, hostname_filter=None):
+    def repo_stats(self, hostname, refresh=False):
         """
-        Show statistics
+        Return restic stats --json of a repository, in restore-size and raw-data mode
+        as dict mode -> stats. The result is cached until the repository changes
+        Returns None on error
         """
-        for hostname, backup in self.backups.iter(hostname_filter):
-            self.print_header("Stats for %s" % hostname)
-            cmd = ["/opt/restic/restic"]
-            cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
-            cmd += ["-p", "/etc/citobackup/restic_password.txt", "stats"]
-            r, txt = citobackup_util.run_cmd(cmd)
-            print(txt)
+        repo = "%s/%s" % (self.config.default_dest, hostname)
+        cache = Repo_Cache(repo, hostname)
+        stats = None
+        if not refresh:
+            stats = cache.load("stats_modes")
+        if stats is None:
+            stats = {}
+            for mode in ["restore-size", "raw-data"]:
+                cmd = [self.local_restic()]
+                cmd += ["-r", repo]
+                cmd += ["-p", "/etc/citobackup/restic_password.txt", "--no-lock", "stats", "--json", "--mode", mode]
+                r, txt = citobackup_util.run_cmd(cmd)
+                try:
+                    stats[mode] = json.loads(r.stdout)
+                except json.decoder.JSONDecodeError:
+                    print("Error: stats failed for %s" % hostname)
+                    print(txt)
+                    return None
+            cache.save("stats_modes", stats)
+        return stats
+
+    def stats(self, hostname_filter=None, refresh=False, jobs=None):
+        """
+        Show statistics for all repositories, in one table
+
+        restore-size is the size of all files in all snapshots, raw-data the
+        size of the unique data. The dedup ratio is restore-size / raw-data,
+        per host and for all hosts. Repositories are read up to jobs in
+        parallel, default stats.jobs, and cached until they change.
+        """
+        if jobs is None:
+            jobs = int((self.config.get("stats", None) or {}).get("jobs", 4))
+        hostnames = [hostname for hostname, backup in self.backups.iter(hostname_filter)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            all_stats = list(executor.map(lambda hostname: self.repo_stats(hostname, refresh=refresh), hostnames))
+
+        def add_row(t, name, snapshots, files, restore_size, raw_size, stored_size):
+            t.add_cell(name)
+            t.add_cell(snapshots)
+            t.add_cell(files)
+            t.add_cell(citobackup_util.human_readable_size(restore_size))
+            t.add_cell(citobackup_util.human_readable_size(raw_size))
+            t.add_cell(citobackup_util.human_readable_size(stored_size))
+            t.add_cell("%.1f" % (restore_size / raw_size) if raw_size else "")
+            t.add_cell("%.2f" % (raw_size / stored_size) if stored_size else "")
+            t.add_row()
+
+        t = citobackup_util.Table(headers=[
+            "hostname", "snapshots", "total<br>files", "restore<br>size", "raw<br>data", "stored",
+            "dedup<br>ratio", "compression<br>ratio",
+        ])
+        total = [0, 0, 0, 0, 0]
+        for hostname, stats in zip(hostnames, all_stats):
+            if stats is None:
+                t.add_cell(hostname)
+                t.add_cell("error")
+                for i in range(6):
+                    t.add_cell("")
+                t.add_row()
+                continue
+            restore = stats["restore-size"]
+            raw = stats["raw-data"]
+            row = [
+                restore.get("snapshots_count", 0),
+                restore.get("total_file_count", 0),
+                restore.get("total_size", 0),
+                raw.get("total_uncompressed_size", raw.get("total_size", 0)),   # restic < 0.14 has no compression
+                raw.get("total_size", 0),
+            ]
+            add_row(t, hostname, *row)
+            total = [a + b for a, b in zip(total, row)]
+        if len(hostnames) > 1:
+            add_row(t, "total", *total)
+        print(t)
 
     def unlock(self, hostname_filter=None, days=365):
         """
         """
         for hostname, backup in self.backups.iter(hostname_filter):
             self.print_header("Unlocking repo %s" % hostname)
-            cmd = ["/opt/restic/restic"]
+            cmd = [self.local_restic()]
             cmd += ["-r", "%s/%s" % (self.config.default_dest, hostname)]
             cmd += ["-p", "/etc/citobackup/restic_password.txt", "unlock", "--json"]
             r, txt = citobackup_util.run_cmd(cmd)
             print(txt)
+
+
+if __name__ == "__main__":
+    # function test, backup of ESXi VMs against the stand-in in remote/esxi-standin.py
+    # The commands of the "remote host" are run locally with sh
+    import itertools
+    import sys
+    import tempfile
+    from citobackup_ssh import Async_SSH
+
+    class Local_Async_SSH(Async_SSH):
+        def ssh_args(self, cmd):
+            return ["sh", "-c", cmd if isinstance(cmd, str) else " ".join(cmd)]
+
+        def scp_args(self, src, dst):
+            return ["cp", src, dst]
+
+        def remote_path(self, path):
+            return path
+
+    class Local_SSH(SSH):
+        def __init__(self, hostname, tmpdir):
+            dict.__init__(self)
+            self.tmpdir = tmpdir
+            self.hostname = hostname
+            self.port = None
+            self.username = None
+            self.password = None
+            self.tunnel_port = TUNNEL_PORT
+            self.tmp_counter = itertools.count(1)
+            self.aio = Local_Async_SSH(self)
+
+        def tmpname(self, name, directory=None):
+            return super().tmpname(name, directory=directory or self.tmpdir)
+
+    class Config(dict):
+        default_dest = "/srv/citobackup"
+
+    remote_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "remote")
+    SPARSE_CAT = os.path.join(remote_dir, "sparse-cat.py")
+    standin = "%s %s" % (sys.executable, os.path.join(remote_dir, "esxi-standin.py"))
+
+    def esxi_backup(tmpdir, vmdir, statefile, state):
+        with open(statefile, "w") as f:
+            json.dump(state, f)
+        restic = Restic(config=Config(), backups=None)
+        restic.remote_binary["esxi"] = "%s %s restic" % (standin, statefile)
+        results = citobackup_util.Backup_Results()
+        src = {"vm": "vm1", "vim_cmd": "%s %s vim-cmd" % (standin, statefile),
+               "datastore_root": os.path.dirname(os.path.dirname(vmdir)), "python": sys.executable}
+        restic.backup_esxi(Local_SSH("esxi", os.path.join(tmpdir, "tmp")), src, results=results, name="vms", subname="vm1")
+        with open(statefile) as f:
+            state = json.load(f)
+        return {r.backup_type: r for r in results}, results, state
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vmdir = os.path.join(tmpdir, "volumes", "datastore1", "vm1")
+        os.makedirs(vmdir)
+        os.makedirs(os.path.join(tmpdir, "tmp"))
+        for filename in ["vm1.vmx", "vm1.nvram", "vm1.vmdk", "vm1-000001.vmdk", "vm1-000001-delta.vmdk"]:
+            with open(os.path.join(vmdir, filename), "w") as f:
+                f.write("%s\n" % filename)
+        disk = os.path.join(vmdir, "vm1-flat.vmdk")
+        with open(disk, "wb") as f:
+            f.write(b"boot")
+            f.seek(8 * 1024 * 1024)
+            f.write(b"data")
+        disk_sha256 = hashlib.sha256(open(disk, "rb").read()).hexdigest()
+        statefile = os.path.join(tmpdir, "state.json")
+        vm = {"name": "vm1", "datastore": "datastore1", "vmx": "vm1/vm1.vmx", "power": "Powered on", "snapshots": []}
+
+        # Running VM, the disk is copied from a citobackup snapshot, that is removed after
+        by_type, results, state = esxi_backup(tmpdir, vmdir, statefile, {"vms": {"1": dict(vm)}})
+        assert not by_type["esxi"].errors, by_type["esxi"].errors
+        assert not by_type["esxi-disk"].errors, by_type["esxi-disk"].errors
+        assert by_type["esxi-disk"].snapshot_id
+        backups = {str(b["source"]): b for b in state["backups"]}
+        assert backups["vm1/vm1-flat.vmdk"]["sha256"] == disk_sha256, "disk content differs"
+        config_backup = [b for b in state["backups"] if isinstance(b["source"], list)][0]
+        assert sorted(os.path.basename(path) for path in config_backup["source"]) == ["vm1.nvram", "vm1.vmdk", "vm1.vmx"]
+        assert state["vms"]["1"]["snapshots"] == [], "citobackup snapshot not removed"
+
+        # Snapshot from a failed backup is removed and reported
+        by_type, results, state = esxi_backup(tmpdir, vmdir, statefile, {"vms": {"1": dict(vm, snapshots=[["7", "citobackup"]])}})
+        assert any("previous backup" in e for e in by_type["esxi"].errors)
+        assert "esxi-disk" in by_type and state["vms"]["1"]["snapshots"] == []
+
+        # Snapshot create that does not create a snapshot, the disks are not copied
+        by_type, results, state = esxi_backup(tmpdir, vmdir, statefile, {"vms": {"1": dict(vm)}, "fail_snapshot_create": True})
+        assert any("Snapshot of VM" in e for e in by_type["esxi"].errors)
+        assert "esxi-disk" not in by_type
+
+        # VM with a user snapshot, the -flat.vmdk is old, the disks are not copied
+        by_type, results, state = esxi_backup(tmpdir, vmdir, statefile, {"vms": {"1": dict(vm, snapshots=[["3", "before upgrade"]])}})
+        assert any("has snapshots" in e for e in by_type["esxi"].errors)
+        assert "esxi-disk" not in by_type
+        assert state["vms"]["1"]["snapshots"] == [["3", "before upgrade"]], "user snapshot changed"
+
+        # Disk that can't be read, the snapshot is incomplete
+        os.symlink(os.path.join(tmpdir, "missing"), os.path.join(vmdir, "vm1_1-flat.vmdk"))
+        by_type, results, state = esxi_backup(tmpdir, vmdir, statefile, {"vms": {"1": dict(vm)}})
+        disk_results = {r.subname: r for r in results if r.backup_type == "esxi-disk"}
+        assert not disk_results["vm1/vm1-flat.vmdk"].errors
+        assert any("Read of disk" in e for e in disk_results["vm1/vm1_1-flat.vmdk"].errors)
+        assert not [path for path in os.listdir(os.path.join(tmpdir, "tmp")) if not path.startswith("backup_list")]
+    print("ESXi function test ok")
@@ -4,29 +4,313 @@
 Manage remote host, using SSH
 """
 
-import json
+import asyncio
+import codecs
+import itertools
 import os
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 import citobackup_util
+from citobackup_events import Event_Stream
+
+
+# ----- globals --------------------------------------------------------
+
+TUNNEL_PORT = 44444     # Default remote port, forwarded back to our sshd
+
+# Serialize changes to our local ~/.ssh, hosts are backed up in parallel
+local_ssh_lock = threading.Lock()
+
+# Event loop shared by all hosts, see event_loop()
+_loop = None
+_loop_lock = threading.Lock()
+
+# ----------------------------------------------------------------------
+
+
+def event_loop():
+    """
+    Return the event loop running the Async_SSH engine of all hosts
+    It is started on first use, in its own thread
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="citobackup-ssh", daemon=True).start()
+        return _loop
+
+
+class Async_SSH:
+    """
+    asyncio engine for remote commands and file copy
+
+    All commands are run as asyncio subprocesses over the persistent ssh
+    connection (ControlMaster). The commands of all hosts run in one event
+    loop, see event_loop().
+    """
+
+    LINE_LIMIT = 1024 * 1024    # Longest line in stream_json(), longer lines are skipped
+
+    def __init__(self, srv):
+        self.srv = srv
+
+    def ssh_args(self, cmd):
+        """
+        Return ssh command line, running cmd on the remote host
+        """
+        srv = self.srv
+        if isinstance(cmd, str):
+            cmd = [cmd]
+        c = []
+        if srv.password:
+            c += ["sshpass", "-p", srv.password]
+        c += ["ssh", "-6", "-S", srv.persistent_socket]
+        if srv.port:
+            c += ["-p", str(srv.port)]
+        if srv.username:
+            c += [f"{srv.username}@{srv.hostname}"]
+        else:
+            c += [srv.hostname]
+        c += cmd
+        return c
+
+    def scp_args(self, src, dst):
+        """
+        Return scp command line, copying src to dst
+        """
+        srv = self.srv
+        c = []
+        if srv.password:
+            c += ["/usr/bin/sshpass", "-p", srv.password]
+        c += ["/usr/bin/scp", "-6"]
+        c += ["-o", "ControlPath=%s" % srv.persistent_socket]
+        if srv.port:
+            c += ["-P", str(srv.port)]
+        c += [src, dst]
+        return c
+
+    def remote_path(self, path):
+        """
+        Return path on remote host, in scp syntax
+        """
+        tmp = ""
+        if self.srv.username:
+            tmp += "%s@" % self.srv.username
+        tmp += "%s:" % self.srv.hostname
+        tmp += path
+        return tmp
+
+    async def exec(self, c, input=None, timeout=None, idle_timeout=citobackup_util.NO_TIMEOUT):
+        """
+        Run a local command, capture stdout and stderr
+        The command is killed after timeout seconds, or if there is no output
+        for idle_timeout seconds, see citobackup_util.run_cmd()
+        Only the last citobackup_util.MAX_OUTPUT bytes of output are kept
+        Returns (returncode, stdout/stderr)
+        """
+        started = time.time()
+        start = time.monotonic()
+        timeout = citobackup_util.timeout_value(timeout, citobackup_util.cmd_timeout)
+        idle_timeout = citobackup_util.timeout_value(idle_timeout, citobackup_util.cmd_idle_timeout)
+        p = await asyncio.create_subprocess_exec(
+            *c,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        buffers = [citobackup_util.Ring_Buffer(citobackup_util.MAX_OUTPUT) for ix in range(2)]
+        last_output = [start]
+
+        async def read(f, buf):
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while True:
+                data = await f.read(65536)
+                if not data:
+                    buf.add(decoder.decode(b"", final=True))
+                    return
+                last_output[0] = time.monotonic()
+                buf.add(decoder.decode(data))
+
+        async def write():
+            try:
+                p.stdin.write(input.encode())
+                await p.stdin.drain()
+                p.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        readers = [asyncio.ensure_future(read(p.stdout, buffers[0])),
+                   asyncio.ensure_future(read(p.stderr, buffers[1]))]
+        writer = asyncio.ensure_future(write()) if input is not None else None
+        timed_out = None
+        while True:
+            wait = 1.0
+            if timeout is not None:
+                wait = max(0.01, min(wait, timeout - (time.monotonic() - start)))
+            done, pending = await asyncio.wait(readers, timeout=wait)
+            if not pending:
+                break
+            now = time.monotonic()
+            if timeout is not None and now - start >= timeout:
+                timed_out = "timeout"
+            elif idle_timeout is not None and now - last_output[0] >= idle_timeout:
+                timed_out = "idle"
+            if timed_out:
+                print("Error: %s, killed after %.0f seconds: %s" % (timed_out, now - start, citobackup_util.redact_cmd(c)))
+                p.kill()
+                for task in readers + [writer]:
+                    if task:
+                        task.cancel()
+                await asyncio.gather(*[task for task in readers + [writer] if task], return_exceptions=True)
+                buffers[1].add("%s, killed after %.0f seconds" % (timed_out, now - start))
+                break
+        if writer:
+            await asyncio.gather(writer, return_exceptions=True)
+        await p.wait()
+
+        txt = buffers[0].value()
+        if buffers[1].size:
+            txt += "\n" + buffers[1].value()
+        citobackup_util.log_cmd(c, started, time.monotonic() - start, None, p.returncode,
+                                timed_out=timed_out, output_bytes=buffers[0].total + buffers[1].total,
+                                truncated=buffers[0].truncated or buffers[1].truncated)
+        return p.returncode, txt
+
+    async def run(self, cmd, input=None, timeout=None, idle_timeout=citobackup_util.NO_TIMEOUT):
+        """
+        Run cmd on remote host
+        input, optional string sent to stdin of cmd
+        Returns (returncode, stdout/stderr)
+        """
+        return await self.exec(self.ssh_args(cmd), input=input, timeout=timeout, idle_timeout=idle_timeout)
+
+    async def stream_json(self, cmd, stream=None, timeout=None, idle_timeout=None):
+        """
+        Run cmd on remote host, yield each restic json message as an event
+        stream, Event_Stream that decodes lines and calls subscribers
+        The command is killed after timeout seconds, or if there is no output
+        for idle_timeout seconds. By default citobackup_util.cmd_idle_timeout
+        applies, restic --json writes status lines while it is running
+        """
+        if stream is None:
+            stream = Event_Stream()
+        c = self.ssh_args(cmd)
+        started = time.time()
+        start = time.monotonic()
+        timeout = citobackup_util.timeout_value(timeout, citobackup_util.cmd_timeout)
+        idle_timeout = citobackup_util.timeout_value(idle_timeout, citobackup_util.cmd_idle_timeout)
+        p = await asyncio.create_subprocess_exec(
+            *c,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        eof = False
+        timed_out = None
+        output_bytes = 0
+        partial = b""       # Start of a line, rest not read yet
+        skipping = False    # Skipping the rest of a line longer than LINE_LIMIT
+        try:
+            while True:
+                wait = idle_timeout
+                if timeout is not None:
+                    remaining = max(0, timeout - (time.monotonic() - start))
+                    wait = remaining if wait is None else min(wait, remaining)
+                try:
+                    data = await asyncio.wait_for(p.stdout.read(65536), wait)
+                except asyncio.TimeoutError:
+                    if timeout is not None and time.monotonic() - start >= timeout:
+                        timed_out = "timeout"
+                    else:
+                        timed_out = "idle"
+                    msg = "%s, killed after %.0f seconds" % (timed_out, time.monotonic() - start)
+                    print("Error: %s: %s" % (msg, citobackup_util.redact_cmd(c)))
+                    # Reported as a restic error, the result gets an error
+                    yield stream.emit({
+                        "message_type": "error",
+                        "error": {"message": msg},
+                        "item": citobackup_util.redact_cmd(cmd),
+                    })
+                    break
+                if not data:
+                    eof = True
+                    lines = [partial] if partial and not skipping else []
+                else:
+                    output_bytes += len(data)
+                    lines = (partial + data).split(b"\n")
+                    partial = lines.pop()
+                    if skipping and lines:
+                        lines.pop(0)    # Rest of a line longer than LINE_LIMIT
+                        skipping = False
+                    if len(partial) > self.LINE_LIMIT:
+                        if not skipping:
+                            print("Warning: skipped line longer than %d bytes: %s..." % (
+                                self.LINE_LIMIT, partial[:80].decode(errors="replace")))
+                        partial = b""
+                        skipping = True
+                for line in lines:
+                    if len(line) > self.LINE_LIMIT:
+                        print("Warning: skipped line longer than %d bytes: %s..." % (
+                            self.LINE_LIMIT, line[:80].decode(errors="replace")))
+                        continue
+                    event = stream.feed(line.decode(errors="replace"))
+                    if event is not None:
+                        yield event
+                if eof:
+                    break
+        finally:
+            if not eof:
+                # Consumer stopped early, or timeout
+                try:
+                    p.kill()
+                except ProcessLookupError:
+                    pass
+            await p.wait()
+            citobackup_util.log_cmd(c, started, time.monotonic() - start, None, p.returncode,
+                                    timed_out=timed_out, output_bytes=output_bytes)
+
+    async def put(self, localpath, remotepath, mode=None):
+        """
+        Copy local file to remote host
+        Returns (returncode, output)
+        """
+        returncode, txt = await self.exec(self.scp_args(localpath, self.remote_path(remotepath)))
+        if mode:
+            await self.run(["/bin/chmod", mode, remotepath])
+        return returncode, txt
+
+    async def get(self, remotepath, localpath):
+        """
+        Copy file on remote host to local file
+        Returns (returncode, output)
+        """
+        return await self.exec(self.scp_args(self.remote_path(remotepath), localpath))
 
 
 class SSH(dict):
     """
     """
-    def __init__(self, hostname, port=None, username=None, password=None):
+    def __init__(self, hostname, port=None, username=None, password=None, tunnel_port=None):
         super().__init__()
         if port is None:
             port = 22
+        if tunnel_port is None:
+            tunnel_port = TUNNEL_PORT
 
         self.hostname = hostname
         self.port = port
         self.username = username
         self.password = password
+        self.tunnel_port = tunnel_port
 
         self.persistent_socket = "/tmp/master-%s@%s:%s" % (self.username, self.hostname, self.port)
+        self.tmp_counter = itertools.count(1)
+        self.aio = Async_SSH(self)
 
         # Check and generate local ssh keys
         # Used to connect to remote server
@@ -44,7 +328,7 @@ class SSH(dict):
         cmd += ["-M"]
         cmd += ["-S", self.persistent_socket]
         cmd += ["-p", str(self.port)]
-        cmd += ["-R", "44444:[::1]:22"]
+        cmd += ["-R", "%s:[::1]:22" % self.tunnel_port]
         cmd += [self.hostname]
         print("cmd", " ".join(cmd))
         self.p = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
@@ -69,18 +353,19 @@ class SSH(dict):
         """
         priv_key = os.path.expanduser("/home/citobackup/.ssh/%s" % keyname)
         pub_key = os.path.expanduser("/home/citobackup/.ssh/%s.pub" % keyname)
-        found = True
-        if not os.path.exists(priv_key):
-            found = False
-        if not os.path.exists(pub_key):
-            found = False
-
-        if not found:
-            print(f"Creating key for {keyname} with no password")
-            cmd = ["ssh-keygen", "-f", priv_key, "-N", '""']
-            r, txt = citobackup_util.run_cmd(cmd)
-            print("r =", r)
-            print(txt)
+        with local_ssh_lock:
+            found = True
+            if not os.path.exists(priv_key):
+                found = False
+            if not os.path.exists(pub_key):
+                found = False
+
+            if not found:
+                print(f"Creating key for {keyname} with no password")
+                cmd = ["ssh-keygen", "-f", priv_key, "-N", '""']
+                r, txt = citobackup_util.run_cmd(cmd)
+                print("r =", r)
+                print(txt)
 
     def get_pubkey(self, keyname):
         """
@@ -96,28 +381,29 @@ class SSH(dict):
         """
         # Search our local authorized_keys for the new key, add if it does not exist
         file = os.path.expanduser("/home/citobackup/.ssh/authorized_keys")
-        found = False
-        if not os.path.exists(file):
-            # Create file
-            with open(file, "w") as f:
-                f.write(new_key + "\n")
-            os.chmod(file, 0o600)
-            return
-
-        # Check if we already have the key
-        with open(file, "r") as f:
-            line = f.readline()
-            while line:
-                line = line.strip()
-                if line == new_key:
-                    found = True
-                    break
+        with local_ssh_lock:
+            found = False
+            if not os.path.exists(file):
+                # Create file
+                with open(file, "w") as f:
+                    f.write(new_key + "\n")
+                os.chmod(file, 0o600)
+                return
+
+            # Check if we already have the key
+            with open(file, "r") as f:
                 line = f.readline()
-
-        if not found:
-            # The key did not exist, add key
-            with open(file, "a") as f:
-                f.write(new_key + "\n")
+                while line:
+                    line = line.strip()
+                    if line == new_key:
+                        found = True
+                        break
+                    line = f.readline()
+
+            if not found:
+                # The key did not exist, add key
+                with open(file, "a") as f:
+                    f.write(new_key + "\n")
 
     def get_own_server_key(self):
         # Get our server key
@@ -127,101 +413,46 @@ class SSH(dict):
         local_key = r.stdout.decode()
         return local_key
 
-    def ssh(self, cmd, decode_json=False):
+    def sync(self, coro):
         """
+        Run a coroutine from the Async_SSH engine, and wait for the result
         """
-        if isinstance(cmd, str):
-            cmd = [cmd]
+        return asyncio.run_coroutine_threadsafe(coro, event_loop()).result()
 
-        c = []
-        if self.password:
-            c += ["sshpass", "-p", self.password]
-        c += ["ssh", "-6", "-S", self.persistent_socket]
-
-        if self.port:
-            c += ["-p", str(self.port)]
-
-        if self.username:
-            c += [f"{self.username}@{self.hostname}"]
-        else:
-            c += [self.hostname]
-
-        c += cmd
-
-        # print("c =", c)
+    async def collect_json(self, cmd, stream=None, idle_timeout=None):
+        """
+        Run cmd on remote server, decode restic json output
+        Returns list of error and summary events. Status and verbose_status
+        events are only given to the subscribers of stream
+        """
+        res = []
+        async for event in self.aio.stream_json(cmd, stream=stream, idle_timeout=idle_timeout):
+            if event.message_type in ("error", "summary"):
+                res.append(event)
+            elif event.message_type not in ("status", "verbose_status"):
+                print("Unknown message", event.data)
+        return res
+
+    def ssh(self, cmd, decode_json=False, input=None, stream=None, idle_timeout=None):
+        """
+        Run cmd on remote server
+        input, optional string sent to stdin of cmd
+        decode_json, decode restic json output, returns list of events
+        stream, optional Event_Stream, with subscribers for live events
+        idle_timeout, None for the default, the configured idle timeout with
+        decode_json and no limit without
+        """
         if decode_json:
-            res = []
-            p = subprocess.Popen(c, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-            while True:
-                line = p.stdout.readline()
-                if not line:
-                    break
-                if not line.strip():
-                    continue
-                if line[0] != "{":
-                    # not json
-                    print("Unknown", line)
-                    continue
-                # print("line", line)
-                try:
-                    tmp = json.loads(line)
-                except json.decoder.JSONDecodeError as err:
-                    # if line.startswith(b"subprocess ssh: Warning: Permanently added"):
-                    #     continue
-                    print("Error json decoding", err)
-                    print("  line:", line)
-                    continue
-                if "message_type" in tmp:
-                    if tmp["message_type"] == "error":
-                        res.append(tmp)
-                    elif tmp["message_type"] == "summary":
-                        res.append(tmp)
-                    elif tmp["message_type"] == "status":
-                        if citobackup_util.write_console:
-                            s = ""
-                            if "seconds_elapsed" in tmp:
-                                s += "Seconds elapsed: %i" % tmp["seconds_elapsed"]
-                            if "percent_done" in tmp:
-                                s += ", Percent done: %i" % (tmp["percent_done"] * 100)
-                            if "files_done" in tmp:
-                                s += ", Files done: %i" % tmp["files_done"]
-                            print("\r%s\033[K" % s, end="")
-                    else:
-                        print("Unknown message", tmp)
-                else:
-                    print("Unknown message", tmp)
-            if citobackup_util.write_console:
-                print("\r%s\033[K" % "", end="")
-            print()
-            return res
-        else:
-            r, txt = citobackup_util.run_cmd(c)
-            return txt
+            return self.sync(self.collect_json(cmd, stream=stream, idle_timeout=idle_timeout))
+        if idle_timeout is None:
+            idle_timeout = citobackup_util.NO_TIMEOUT
+        returncode, txt = self.sync(self.aio.run(cmd, input=input, idle_timeout=idle_timeout))
+        return txt
 
     def scp(self, local=None, remote=None, mode=None):
         """
         """
-        c = []
-        if self.password:
-            c += ["/usr/bin/sshpass", "-p", self.password]
-        c += ["/usr/bin/scp", "-6"]
-        c += ["-o", "ControlPath=%s" % self.persistent_socket]
-        if self.port:
-            c += ["-P", str(self.port)]
-        if local:
-            c += [local]
-
-        tmp = ""
-        if self.username:
-            tmp += "%s@" % self.username
-        tmp += "%s:" % self.hostname
-        tmp += remote
-        c += [tmp]
-
-        r, txt = citobackup_util.run_cmd(c)
-
-        if mode:
-            self.chmod(remote, mode)
+        returncode, txt = self.sync(self.aio.put(local, remote, mode=mode))
         return txt
 
     def rsync(self, local=None, remote=None):
@@ -242,6 +473,13 @@ class SSH(dict):
 
     # ----- convenience functions -----
 
+    def tmpname(self, name, directory="/tmp"):
+        """
+        Return an unique filename on remote server
+        Backup items on a host can run in parallel, so they can't share files
+        """
+        return "%s/%s.%d" % (directory, name, next(self.tmp_counter))
+
     def file_exists(self, filename):
         """
         Check if filename exist on remote server
@@ -290,7 +528,8 @@ class SSH(dict):
         raise RuntimeError("Not implemented")
 
     def get(self, remotepath, localpath, callback=None):
-        raise RuntimeError("Not implemented")
+        returncode, txt = self.sync(self.aio.get(remotepath, localpath))
+        return txt
 
     def getcwd(self):
         raise RuntimeError("Not implemented")
@@ -308,7 +547,8 @@ class SSH(dict):
         raise RuntimeError("Not implemented")
 
     def put(self, localpath, remotepath, callback=None, confirm=True):
-        raise RuntimeError("Not implemented")
+        returncode, txt = self.sync(self.aio.put(localpath, remotepath))
+        return txt
 
     def remove(self, path):
         raise RuntimeError("Not implemented")
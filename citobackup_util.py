@@ -4,14 +4,34 @@
 Common stuff for cito_backup
 """
 
+import codecs
+import collections
+import datetime
+import hashlib
+import json
+import os
+import re
+import selectors
 import subprocess
 import sys
+import threading
+import time
 
 
 write_console = sys.stdout.isatty()     # If true, write additonal output
 
+CACHE_DIR = "/home/citobackup/.cache/citobackup"   # Local state, kept between runs
+
 SIZE_UNITS = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
 
+# Commands, defaults set from configuration
+cmd_timeout = None          # Seconds a command may run, None for no limit
+cmd_idle_timeout = None     # Seconds a restic --json stream may run without output
+NO_TIMEOUT = object()       # Timeout argument for no limit, None is the default
+MAX_OUTPUT = 64 * 1024 * 1024   # Bytes of stdout and stderr kept, the last part is kept
+
+cmdlog_lock = threading.Lock()
+
 
 def human_readable_size(size):
     """
@@ -27,6 +47,58 @@ def human_readable_size(size):
         return size
 
 
+BINARY_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4, "PiB": 1024 ** 5}
+
+
+def parse_size(txt):
+    """
+    Parse a size from restic text output, "1.234 GiB", to bytes
+    Also accepts sizes in configuration, "10G", "500M", "1024"
+    Returns None if not a size
+    """
+    txt = str(txt).strip()
+    value, sep, unit = txt.partition(" ")
+    if not sep:
+        unit = txt.lstrip("0123456789.")
+        value = txt[:len(txt) - len(unit)]
+        if unit and unit[0] in "KMGTP":
+            unit = unit[0] + "iB"
+    try:
+        return int(float(value) * BINARY_UNITS[unit or "B"])
+    except (ValueError, KeyError):
+        return None
+
+
+def parse_time(txt):
+    """
+    Parse a RFC3339 time from restic, "2021-04-20T02:27:18.123456789+02:00"
+    Returns seconds since epoch, None if not a time
+    """
+    m = re.match(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$", txt or "")
+    if not m:
+        return None
+    tz = "+00:00" if m.group(3) == "Z" else m.group(3)
+    t = datetime.datetime.fromisoformat(m.group(1) + tz).timestamp()
+    if m.group(2):
+        t += float(m.group(2))
+    return t
+
+
+def parse_age(txt):
+    """
+    Parse a time from the command line, "7d" (days ago), "12h" (hours ago),
+    "2024-01-31" or "2024-01-31 12:00" (local time)
+    Returns seconds since epoch, None if not a time
+    """
+    m = re.match(r"^(\d+)([dh])$", txt)
+    if m:
+        return time.time() - int(m.group(1)) * (86400 if m.group(2) == "d" else 3600)
+    try:
+        return datetime.datetime.fromisoformat(txt).timestamp()
+    except ValueError:
+        return None
+
+
 class Table:
     """
     Class to easily create tables, for CLI or HTML
@@ -177,6 +249,13 @@ class Backup_Result:
         self.total_bytes_processed = 0
         self.total_duration = 0
         self.snapshot_id = 0
+        self.mbps_avg = 0       # Throughput, MB/s
+        self.mbps_peak = 0
+        self.unchanged = False  # Database unchanged, snapshot_id is from last backup
+        self.downtime = None    # Seconds an application was stopped
+        self.data_added = 0     # Bytes added to the repository
+        self.started = time.time()
+        self.phases = {}        # phase -> seconds, dump, restic, connect...
 
     def add_error(self, msg):
         self.errors.append(msg)
@@ -184,6 +263,9 @@ class Backup_Result:
     def add_output(self, msg):
         self.output.append(msg)
 
+    def add_phase(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
 
 class Backup_Results:
     """
@@ -194,6 +276,9 @@ class Backup_Results:
 
     def add(self, result):
         self.results.append(result)
+
+    def extend(self, results):
+        self.results += results.results
     
     def __iter__(self):
         for result in self.results:
@@ -246,24 +331,312 @@ class Backup_Results2:
         pass
 
 
-def run_cmd(cmd):
+def cache_file(*parts):
+    """
+    Return path to a file in the local cache directory
+    Missing directories are created
+    """
+    filename = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    return filename
+
+
+def load_json(filename, default=None):
+    """
+    Load json data from a file
+    Returns default if the file does not exist or can't be decoded
+    """
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(filename, data):
+    """
+    Save data as json to a file
+    The file is replaced atomically, a reader never sees a partial file
+    """
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmpfile, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmpfile, filename)
+
+
+def sha256_file(filename):
+    """
+    Return sha256 hex digest of a file
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def redact_cmd(cmd):
+    """
+    Return command as one string for the log, without passwords
+    """
+    if isinstance(cmd, str):
+        cmd = [cmd]
+    cmd = list(cmd)
+    for ix, arg in enumerate(cmd):
+        if os.path.basename(arg) == "sshpass" and ix + 2 < len(cmd) and cmd[ix + 1] == "-p":
+            cmd[ix + 2] = "***"
+        elif arg == "--password" and ix + 1 < len(cmd):
+            cmd[ix + 1] = "***"
+        elif arg.startswith("--password="):
+            cmd[ix] = "--password=***"
+    txt = " ".join(str(arg) for arg in cmd)
+    return re.sub(r"(--password\s+)\S+", r"\g<1>***", txt)[:1000]
+
+
+def log_cmd(cmd, started, wall, cpu, returncode, timed_out=None, output_bytes=0, truncated=False):
+    """
+    Append one line for an executed command to the command log
+    ~/.cache/citobackup/cmdlog/<date>.jsonl, one file per day
+    """
+    entry = {
+        "time": round(started, 3),
+        "cmd": redact_cmd(cmd),
+        "returncode": returncode,
+        "wall": round(wall, 3),
+        "cpu": round(cpu, 3) if cpu is not None else None,
+        "timed_out": timed_out,
+        "output_bytes": output_bytes,
+        "truncated": truncated,
+    }
+    try:
+        filename = cache_file("cmdlog", time.strftime("%Y-%m-%d.jsonl", time.localtime(started)))
+        with cmdlog_lock:
+            with open(filename, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+    except OSError as err:
+        print("Warning: can't write command log:", err)
+
+
+def wait_rusage(proc):
+    """
+    Wait for a subprocess to exit, with os.wait4 to get its resource usage
+    Sets proc.returncode, returns CPU seconds (user + system) used
+    """
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            # Already reaped
+            proc.wait()
+            return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+class Ring_Buffer:
+    """
+    Keep the last max_bytes of a text stream
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.total = 0          # All bytes seen
+        self.truncated = False
+
+    def add(self, txt):
+        self.chunks.append(txt)
+        self.size += len(txt)
+        self.total += len(txt)
+        while self.size > self.max_bytes:
+            excess = self.size - self.max_bytes
+            if len(self.chunks[0]) <= excess:
+                self.size -= len(self.chunks.popleft())
+            else:
+                self.chunks[0] = self.chunks[0][excess:]
+                self.size -= excess
+            self.truncated = True
+
+    def value(self):
+        return "".join(self.chunks)
+
+
+class Cmd_Result:
+    """
+    Result of run_cmd()
+    """
+    def __init__(self, cmd):
+        self.args = cmd
+        self.returncode = None
+        self.output = ""        # stdout, and stderr after a newline if there is any
+        self.stdout_len = 0
+        self.wall = 0           # Seconds
+        self.cpu = None         # CPU seconds, user + system
+        self.timed_out = None   # "timeout" or "idle" if the command was killed
+        self.truncated = False  # Output larger than max_output, only the last part is kept
+
+    @property
+    def stdout(self):
+        return self.output[:self.stdout_len]
+
+    @property
+    def stderr(self):
+        return self.output[self.stdout_len + 1:]
+
+
+class Stream_Cmd:
+    """
+    Run a command, iterate over stdout one line at a time
+    stderr is not captured. The exit code is in returncode when all output is
+    read. If iteration is stopped early, the command is killed.
+    Wall and CPU time, and exit status are written to the command log.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.returncode = None
+
+    def __iter__(self):
+        started = time.time()
+        start = time.monotonic()
+        proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        output_bytes = 0
+        complete = False
+        try:
+            for line in proc.stdout:
+                output_bytes += len(line)
+                yield line
+            complete = True
+        finally:
+            if not complete:
+                proc.kill()
+            proc.stdout.close()
+            cpu = wait_rusage(proc)
+            if complete:
+                self.returncode = proc.returncode
+            log_cmd(self.cmd, started, time.monotonic() - start, cpu, proc.returncode, output_bytes=output_bytes)
+
+
+def timeout_value(value, default):
+    """
+    Return a timeout argument in seconds, or None for no limit
+    value None gives default, NO_TIMEOUT gives no limit
+    """
+    if value is None:
+        return default
+    if value is NO_TIMEOUT:
+        return None
+    return value
+
+
+def run_cmd(cmd, input=None, timeout=None, idle_timeout=NO_TIMEOUT, callback=None, max_output=MAX_OUTPUT):
     """
-    Run a shell command and capture stdout and stderr
-    returns (exit_code, stdout/stderr)
+    Run a command and capture stdout and stderr
+
+    input, optional string sent to stdin
+    timeout, kill the command after this many seconds
+    idle_timeout, kill the command if there is no output for this many seconds
+    callback, optional, called with each line of stdout as it arrives
+    max_output, only the last max_output bytes of stdout and stderr are kept
+
+    A timeout of None is the default, cmd_timeout or cmd_idle_timeout, and
+    NO_TIMEOUT is no limit. By default there is no idle timeout, dumps,
+    check and prune can be silent for hours. Wall and CPU time, and exit
+    status are written to the command log.
+    returns (Cmd_Result, stdout/stderr)
     """
-    # print("cmd", cmd)
-    r = subprocess.run(
+    timeout = timeout_value(timeout, cmd_timeout)
+    idle_timeout = timeout_value(idle_timeout, cmd_idle_timeout)
+    r = Cmd_Result(cmd)
+    started = time.time()
+    start = time.monotonic()
+    proc = subprocess.Popen(
         cmd,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        universal_newlines=True,
     )
-    txt = r.stdout
-    if r.stderr:
-        txt += "\n" + r.stderr
-    # print("output =", txt.strip())
-    # print()
-    return r, txt
+    if input is not None:
+        # In a thread, a large input can't block reading the output
+        def write_input():
+            try:
+                proc.stdin.write(input.encode())
+                proc.stdin.close()
+            except OSError:
+                pass
+        writer = threading.Thread(target=write_input, daemon=True)
+        writer.start()
+
+    buffers = {}
+    decoders = {}
+    partial = ""    # Incomplete last line of stdout, for callback
+    sel = selectors.DefaultSelector()
+    for name, f in [["stdout", proc.stdout], ["stderr", proc.stderr]]:
+        sel.register(f, selectors.EVENT_READ, name)
+        buffers[name] = Ring_Buffer(max_output)
+        decoders[name] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    last_output = start
+    open_streams = 2
+    while open_streams:
+        now = time.monotonic()
+        wait = 1.0
+        if timeout is not None:
+            if now - start >= timeout:
+                r.timed_out = "timeout"
+                break
+            wait = min(wait, timeout - (now - start))
+        if idle_timeout is not None:
+            if now - last_output >= idle_timeout:
+                r.timed_out = "idle"
+                break
+            wait = min(wait, idle_timeout - (now - last_output))
+        for key, mask in sel.select(timeout=max(wait, 0.01)):
+            data = os.read(key.fileobj.fileno(), 65536)
+            if not data:
+                sel.unregister(key.fileobj)
+                open_streams -= 1
+                txt = decoders[key.data].decode(b"", final=True)
+            else:
+                last_output = time.monotonic()
+                txt = decoders[key.data].decode(data)
+            buffers[key.data].add(txt)
+            if callback and key.data == "stdout":
+                lines = (partial + txt).split("\n")
+                partial = lines.pop()
+                for line in lines:
+                    callback(line)
+    sel.close()
+
+    if r.timed_out:
+        print("Error: %s, killed after %.0f seconds: %s" % (r.timed_out, time.monotonic() - start, redact_cmd(cmd)))
+        proc.kill()
+    elif callback and partial:
+        callback(partial)
+    proc.stdout.close()
+    proc.stderr.close()
+    r.cpu = wait_rusage(proc)
+    r.wall = time.monotonic() - start
+    r.returncode = proc.returncode
+    r.truncated = buffers["stdout"].truncated or buffers["stderr"].truncated
+    log_cmd(cmd, started, r.wall, r.cpu, r.returncode, timed_out=r.timed_out,
+            output_bytes=buffers["stdout"].total + buffers["stderr"].total, truncated=r.truncated)
+
+    # Output is joined once, stdout and stderr of the result are slices of it
+    chunks = buffers["stdout"].chunks
+    r.stdout_len = buffers["stdout"].size
+    if buffers["stderr"].size:
+        chunks.append("\n")
+        chunks.extend(buffers["stderr"].chunks)
+    buffers.clear()
+    r.output = "".join(chunks)
+    chunks.clear()
+    return r, r.output
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for an ESXi host, to test backup of ESXi VMs without one
+
+    esxi-standin.py STATEFILE vim-cmd vmsvc/...
+    esxi-standin.py STATEFILE restic [restic backup arguments]
+
+vim-cmd answers getallvms, power.getstate and snapshot.get/create/remove with
+the output format of ESXi, from the VMs in the json state file. restic reads the
+backup source, stdin or files, and writes json status and summary lines. The
+backups are saved in the state file.
+
+State file:
+    {
+        "vms": {"1": {"name": "vm1", "datastore": "datastore1", "vmx": "vm1/vm1.vmx",
+                      "power": "Powered on", "snapshots": [["1", "citobackup"]]}},
+        "fail_snapshot_create": false,
+    }
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+
+def load(statefile):
+    with open(statefile) as f:
+        return json.load(f)
+
+
+def save(statefile, state):
+    with open(statefile + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(statefile + ".tmp", statefile)
+
+
+def vim_cmd(state, args):
+    """
+    Returns exit code
+    """
+    cmd = args[0] if args else ""
+    vms = state.setdefault("vms", {})
+    if cmd == "vmsvc/getallvms":
+        print("Vmid   Name          File                        Guest OS       Version   Annotation")
+        for vmid, vm in sorted(vms.items()):
+            print("%-6s %-13s [%s] %-20s otherGuest64   vmx-13" % (vmid, vm["name"], vm["datastore"], vm["vmx"]))
+        return 0
+
+    vm = vms.get(args[1] if len(args) > 1 else "", None)
+    if vm is None:
+        print("vim.fault.NotFound")
+        return 1
+    snapshots = vm.setdefault("snapshots", [])
+    if cmd == "vmsvc/power.getstate":
+        print("Retrieved runtime info")
+        print(vm.get("power", "Powered on"))
+    elif cmd == "vmsvc/snapshot.get":
+        print("Get Snapshot:")
+        prefix = "|-"
+        for snapshot_id, name in snapshots:
+            print("%sROOT" % prefix)
+            print("--Snapshot Name        : %s" % name)
+            print("--Snapshot Id        : %s" % snapshot_id)
+            print("--Snapshot Desciption  : ")
+            print("--Snapshot State       : powered on")
+            prefix = "--|-"
+    elif cmd == "vmsvc/snapshot.create":
+        if state.get("fail_snapshot_create", False):
+            print("Create Snapshot:")
+            print("Snapshot not taken since the state of the virtual machine has not changed")
+            return 0    # As ESXi, the exit code does not tell
+        state["next_snapshot"] = state.get("next_snapshot", 0) + 1
+        snapshots.append([str(state["next_snapshot"]), args[2]])
+        print("Create Snapshot:")
+    elif cmd == "vmsvc/snapshot.remove":
+        vm["snapshots"] = [s for s in snapshots if s[0] != args[2]]
+        print("Remove Snapshot:")
+    else:
+        print("Unknown command %s" % cmd)
+        return 1
+    return 0
+
+
+def restic(state, args):
+    """
+    Returns exit code
+    """
+    paths = []
+    stdin_filename = None
+    tags = []
+    ix = args.index("backup") + 1 if "backup" in args else len(args)
+    while ix < len(args):
+        arg = args[ix]
+        if arg in ["-r", "-p", "--password-file", "--repo", "--host"]:
+            ix += 1
+        elif arg == "--tag":
+            ix += 1
+            tags.append(args[ix])
+        elif arg == "--stdin-filename":
+            ix += 1
+            stdin_filename = args[ix]
+        elif arg == "--files-from":
+            ix += 1
+            with open(args[ix]) as f:
+                paths += [line.strip() for line in f if line.strip()]
+        elif arg == "--stdin":
+            stdin_filename = stdin_filename or "stdin"
+        elif not arg.startswith("-"):
+            paths.append(arg)
+        ix += 1
+
+    start = time.time()
+    h = hashlib.sha256()
+    size = 0
+    files = 0
+    if stdin_filename:
+        source = stdin_filename
+        while True:
+            data = sys.stdin.buffer.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+        files = 1
+    else:
+        source = paths
+        for path in paths:
+            for root, dirs, filenames in os.walk(path) if os.path.isdir(path) else [["", [], [path]]]:
+                for filename in filenames:
+                    with open(os.path.join(root, filename), "rb") as f:
+                        data = f.read()
+                    h.update(data)
+                    size += len(data)
+                    files += 1
+    print(json.dumps({"message_type": "status", "percent_done": 1, "total_files": files, "bytes_done": size}))
+    snapshot_id = hashlib.sha256(("%s %s" % (source, time.time())).encode()).hexdigest()
+    print(json.dumps({
+        "message_type": "summary",
+        "files_new": files, "files_changed": 0, "files_unmodified": 0,
+        "dirs_new": 0, "dirs_changed": 0, "dirs_unmodified": 0,
+        "data_added": size, "total_files_processed": files,
+        "total_bytes_processed": 0 if stdin_filename else size,
+        "total_duration": time.time() - start, "snapshot_id": snapshot_id,
+    }))
+    state.setdefault("backups", []).append({
+        "source": source, "tags": tags, "size": size, "sha256": h.hexdigest(), "snapshot_id": snapshot_id,
+    })
+    return 0
+
+
+def main():
+    statefile, role, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    state = load(statefile)
+    if role == "vim-cmd":
+        ret = vim_cmd(state, args)
+    else:
+        ret = restic(state, args)
+    save(statefile, state)
+    sys.exit(ret)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Write a file to stdout, without reading the holes in a sparse file
+
+Used for ESXi -flat.vmdk files. Holes are written as zeros, the output is
+identical to cat. If the filesystem can't report holes, the whole file is read.
+
+Runs on the remote host, keep it compatible with the python on ESXi
+"""
+
+import errno
+import os
+import sys
+
+BLOCK = 1024 * 1024
+ZERO = bytes(BLOCK)
+
+
+def write_zeros(out, length):
+    while length > 0:
+        n = min(length, BLOCK)
+        out.write(ZERO[:n])
+        length -= n
+
+
+def copy(fd, out, start, end):
+    os.lseek(fd, start, os.SEEK_SET)
+    pos = start
+    while pos < end:
+        data = os.read(fd, min(BLOCK, end - pos))
+        if not data:
+            break
+        out.write(data)
+        pos += len(data)
+    if pos < end:
+        # File shrunk while reading, keep the size
+        write_zeros(out, end - pos)
+
+
+def main(filename):
+    out = sys.stdout.buffer
+    fd = os.open(filename, os.O_RDONLY)
+    size = os.fstat(fd).st_size
+    seek_data = getattr(os, "SEEK_DATA", None)
+    pos = 0
+    while pos < size:
+        if seek_data is None:
+            data, hole = pos, size
+        else:
+            try:
+                data = os.lseek(fd, pos, os.SEEK_DATA)
+                hole = os.lseek(fd, data, os.SEEK_HOLE)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    # Only a hole left
+                    data, hole = size, size
+                else:
+                    # Holes not supported
+                    seek_data = None
+                    continue
+        write_zeros(out, data - pos)
+        copy(fd, out, data, min(hole, size))
+        pos = min(hole, size)
+    os.close(fd)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])